@@ -1,14 +1,22 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+import gc
 import logging
 import os
+import anyio.to_thread
 import asyncio
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+import hashlib
+import time
 import uuid
-import PyPDF2
+import pypdfium2 as pdfium
 import io
 
-from models.email_models import EmailRequest, EmailClassificationResponse
+from models.email_models import EmailRequest, EmailClassificationResponse, Email, StructuredResponse, ClassificationResult
 from models.company_models import CompanyConfigRequest, CompanyConfigResponse
 from services.classifier import EmailClassifier
 from services.company_service import CompanyService
@@ -20,7 +28,8 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Email Classification API",
     description="API para classificação de emails e geração de respostas automáticas",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse  # serialização JSON via orjson (2-5x mais rápida)
 )
 
 origins = [
@@ -41,18 +50,151 @@ app.add_middleware(
 classifier = EmailClassifier()
 company_service = CompanyService()
 
+# Pools para extração de PDF em paralelo
+# PDFs pequenos usam threads (evita overhead de IPC), grandes usam processos
+_SMALL_PDF_THRESHOLD = 256 * 1024  # 256KB
+_pdf_process_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+_pdf_thread_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Templates imutáveis para os caminhos de timeout/erro — montados uma única
+# vez e só copiados com os campos variáveis quando erros acontecem em rajada
+_TIMEOUT_RESPONSE_TEMPLATE = StructuredResponse.model_construct(
+    to="cliente@email.com",
+    subject="Resposta",
+    body="Prezado(a),\n\nRecebemos sua mensagem e vamos analisá-la em breve.\n\nAtenciosamente,\nEquipe de Suporte"
+)
+_ERROR_RESPONSE_TEMPLATE = StructuredResponse.model_construct(
+    to="cliente@email.com",
+    subject="Resposta",
+    body="Prezado(a),\n\nRecebemos sua mensagem. Nossa equipe irá analisá-la e retornar em breve.\n\nAtenciosamente,\nEquipe de Suporte"
+)
+_TIMEOUT_SHELL_TEMPLATE = EmailClassificationResponse.model_construct(
+    id="",
+    email=None,
+    category="productive",
+    reasoning="Timeout no processamento - classificação padrão aplicada",
+    suggestedResponse=None,
+    processedAt=None
+)
+_ERROR_SHELL_TEMPLATE = EmailClassificationResponse.model_construct(
+    id="",
+    email=None,
+    category="productive",
+    reasoning="Erro no processamento - classificação padrão aplicada",
+    suggestedResponse=None,
+    processedAt=None
+)
+
+# Cache LRU de classificações: emails duplicados (retries, deduplicação de
+# tickets) saem daqui sem custo de IA/Gemini. Entradas expiram por TTL e
+# resultados degradados (fallback durante outage do Gemini) nunca entram -
+# senão um retry idêntico continuaria servindo o fallback depois da API
+# se recuperar
+_CLASSIFICATION_CACHE_SIZE = 1024
+_CLASSIFICATION_CACHE_TTL = 3600
+_NON_CACHEABLE_METHODS = {'NLP_fallback', 'default', 'unknown'}
+_classification_cache: "OrderedDict[bytes, dict]" = OrderedDict()
+_classification_cache_hits = 0
+
+def _classification_cache_key(request: EmailRequest) -> bytes:
+    # O sender entra na chave: a resposta sugerida é endereçada a ele
+    # (campo 'to', saudação), então usuários diferentes com conteúdo
+    # idêntico não podem compartilhar a mesma entrada
+    return hashlib.blake2b(
+        f"{request.config_id}|{request.sender}|{request.subject}|{request.content}".encode(),
+        digest_size=16
+    ).digest()
+
+# Pool de UUIDs pré-gerados: um único os.urandom(16KB) rende 1024 UUIDs,
+# evitando duas syscalls por request no caminho quente
+_uuid_pool = deque(maxlen=4096)
+
+async def _refill_uuids():
+    """Reabastece o pool de UUIDs em background"""
+    while True:
+        if len(_uuid_pool) < 1024:
+            raw = os.urandom(16 * 1024)
+            for i in range(0, len(raw), 16):
+                _uuid_pool.append(str(uuid.UUID(bytes=raw[i:i + 16], version=4)))
+        await asyncio.sleep(0.5)
+
+def next_uuid() -> str:
+    """Retorna um UUID do pool, caindo para uuid4() se estiver vazio"""
+    try:
+        return _uuid_pool.popleft()
+    except IndexError:
+        return str(uuid.uuid4())
+
+# Timestamp cacheado com ~1ms de resolução: evita um clock_gettime + alocação
+# de datetime por uso nos caminhos quentes (timestamps de resposta não
+# precisam de precisão exata)
+_now_cache = datetime.now()
+
+async def _tick_now():
+    global _now_cache
+    while True:
+        _now_cache = datetime.now()
+        await asyncio.sleep(0.001)
+
+def cached_now() -> datetime:
+    return _now_cache
+
+@app.on_event("startup")
+async def _start_background_tasks():
+    asyncio.create_task(_refill_uuids())
+    asyncio.create_task(_tick_now())
+
+@app.on_event("shutdown")
+async def _close_http_sessions():
+    await classifier.ai_service.close()
+
+def _count_pages(pdf_bytes: bytes) -> int:
+    """Abre o documento só para contar páginas (parsing lazy do pdfium)"""
+    pdf_doc = pdfium.PdfDocument(pdf_bytes)
+    try:
+        return len(pdf_doc)
+    finally:
+        pdf_doc.close()
+
+def _extract_page(page_num: int, pdf_bytes: bytes):
+    """
+    Extrai texto de uma única página do PDF.
+    Abre seu próprio PdfDocument sobre os bytes compartilhados para ser
+    seguro entre threads/processos. Retorna (page_num, texto).
+    """
+    pdf_doc = pdfium.PdfDocument(pdf_bytes)
+    try:
+        page = pdf_doc.get_page(page_num)
+        try:
+            textpage = page.get_textpage()
+            try:
+                return page_num, textpage.get_text_range()
+            finally:
+                textpage.close()
+        finally:
+            page.close()
+    finally:
+        pdf_doc.close()
+
 @app.get("/")
 async def root():
     return {"message": "Email Classification API is running", "version": "1.0.0"}
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now(),  # orjson serializa datetime nativamente
+        "classification_cache_hits": _classification_cache_hits
+    }
 
 @app.post("/extract-pdf")
-async def extract_pdf(file: UploadFile = File(...)):
+async def extract_pdf(file: UploadFile = File(...), stream: bool = False):
     """
     Extrai texto de arquivo PDF
+
+    Com ?stream=true o texto é enviado página a página (memória constante);
+    caso contrário retorna o JSON tradicional com o texto completo.
     """
     try:
         # Validação do tipo de arquivo
@@ -60,50 +202,114 @@ async def extract_pdf(file: UploadFile = File(...)):
             raise HTTPException(status_code=400, detail="Apenas arquivos PDF são aceitos")
         
         # Validação do tamanho (10MB máximo)
-        contents = await file.read()
-        file_size = len(contents)
         max_size = 10 * 1024 * 1024  # 10MB
-        
-        if file_size > max_size:
+
+        # Rejeita cedo pelo Content-Length declarado, antes de ler qualquer byte
+        declared_size = file.headers.get('content-length')
+        if declared_size and declared_size.isdigit() and int(declared_size) > max_size:
             raise HTTPException(
-                status_code=400, 
-                detail=f"Arquivo muito grande. Tamanho máximo: 10MB. Tamanho atual: {file_size / (1024*1024):.1f}MB"
+                status_code=400,
+                detail=f"Arquivo muito grande. Tamanho máximo: 10MB. Tamanho atual: {int(declared_size) / (1024*1024):.1f}MB"
             )
+
+        # Lê em blocos de 64KB abortando assim que o limite for excedido,
+        # em vez de carregar o upload inteiro na memória antes de validar
+        chunks = []
+        file_size = 0
+        while chunk := await file.read(65536):
+            file_size += len(chunk)
+            if file_size > max_size:
+                raise HTTPException(
+                    status_code=400,
+                    detail="Arquivo muito grande. Tamanho máximo: 10MB"
+                )
+            chunks.append(chunk)
+        contents = b"".join(chunks)
+        del chunks
         
         logger.info(f"Processing PDF: {file.filename} ({file_size / 1024:.1f}KB)")
         
-        # Extrair texto do PDF
-        pdf_file = io.BytesIO(contents)
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        
+        # Extrair texto do PDF: até a abertura/contagem de páginas sai do
+        # event loop para não travar os demais endpoints
+        num_pages = await anyio.to_thread.run_sync(_count_pages, contents)
+
         # Verificar se o PDF tem páginas
-        if len(pdf_reader.pages) == 0:
+        if num_pages == 0:
             raise HTTPException(status_code=400, detail="PDF não contém páginas")
-        
-        # Extrair texto de todas as páginas
-        text_parts = []
-        for page_num, page in enumerate(pdf_reader.pages):
-            try:
-                text = page.extract_text()
-                if text.strip():
-                    text_parts.append(text)
-                logger.info(f"Extracted {len(text)} characters from page {page_num + 1}")
-            except Exception as e:
-                logger.warning(f"Error extracting page {page_num + 1}: {e}")
+
+        pool = _pdf_thread_pool if file_size < _SMALL_PDF_THRESHOLD else _pdf_process_pool
+        loop = asyncio.get_running_loop()
+
+        # Modo streaming: emite cada página assim que extraída e libera antes
+        # da próxima — memória de pico fica em O(uma página)
+        if stream:
+            async def _page_stream():
+                pages_sent = 0
+                for page_num in range(num_pages):
+                    try:
+                        _, text = await loop.run_in_executor(pool, _extract_page, page_num, contents)
+                    except Exception as e:
+                        logger.warning(f"Error extracting page {page_num + 1}: {e}")
+                        continue
+                    if not text.strip():
+                        continue
+                    if pages_sent:
+                        yield "\n\n"
+                    yield text
+                    pages_sent += 1
+
+            return StreamingResponse(
+                _page_stream(),
+                media_type="text/plain; charset=utf-8",
+                headers={"X-PDF-Pages": str(num_pages), "X-PDF-Filename": file.filename}
+            )
+
+        # Extrair texto de todas as páginas em paralelo
+        results = await asyncio.gather(
+            *[loop.run_in_executor(pool, _extract_page, page_num, contents) for page_num in range(num_pages)],
+            return_exceptions=True
+        )
+
+        # Escreve cada página incrementalmente num buffer spooled (vai para
+        # disco acima de 1MB), liberando cada parte após consumida — nunca
+        # mantém duas cópias completas do texto em memória
+        spool = tempfile.SpooledTemporaryFile(max_size=1 << 20, mode='w+', encoding='utf-8')
+        pages_with_text = 0
+        for page_num, result in enumerate(results):
+            if isinstance(result, Exception):
+                logger.warning(f"Error extracting page {page_num + 1}: {result}")
                 continue
-        
-        if not text_parts:
+            idx, text = result
+            results[page_num] = None
+            if text.strip():
+                if pages_with_text:
+                    spool.write("\n\n")
+                spool.write(text)
+                pages_with_text += 1
+            logger.info(f"Extracted {len(text)} characters from page {idx + 1}")
+
+        if pages_with_text == 0:
+            spool.close()
             raise HTTPException(
-                status_code=400, 
+                status_code=400,
                 detail="Não foi possível extrair texto do PDF. O arquivo pode estar vazio ou protegido."
             )
-        
-        extracted_text = "\n\n".join(text_parts)
-        logger.info(f"Successfully extracted {len(extracted_text)} characters from {len(text_parts)} pages")
-        
+
+        spool.seek(0)
+        extracted_text = spool.read()
+        spool.close()
+
+        # Libera o buffer do PDF antes de montar a resposta; uploads grandes
+        # forçam uma coleta para devolver memória ao SO mais cedo
+        del contents, results
+        if file_size > 2 * 1024 * 1024:
+            gc.collect()
+
+        logger.info(f"Successfully extracted {len(extracted_text)} characters from {pages_with_text} pages")
+
         return {
             "text": extracted_text,
-            "pages": len(pdf_reader.pages),
+            "pages": num_pages,
             "filename": file.filename,
             "size_kb": round(file_size / 1024, 1)
         }
@@ -120,9 +326,10 @@ async def create_company_config(request: CompanyConfigRequest):
     try:
         logger.info(f"Creating config for company: {request.company_name}")
         
-        config = company_service.create_config(request)
-        
-        return CompanyConfigResponse(
+        config = await company_service.create_config(request)
+
+        # Dados já validados na entrada - model_construct pula a revalidação
+        return CompanyConfigResponse.model_construct(
             config_id=config.config_id,
             company_name=config.company_name,
             message="Configuração criada com sucesso! Guarde este código para usar no sistema."
@@ -134,24 +341,46 @@ async def create_company_config(request: CompanyConfigRequest):
 @app.get("/company-config/{config_id}")
 async def get_company_config(config_id: str):
     """Get company configuration by ID"""
-    config = company_service.get_config(config_id)
+    config = await company_service.get_config(config_id)
     if not config:
         raise HTTPException(status_code=404, detail="Configuração não encontrada")
     return config
 
+def _fallback_classification_response(
+    shell_template: EmailClassificationResponse,
+    response_template: StructuredResponse,
+    request: EmailRequest
+) -> EmailClassificationResponse:
+    """Copia os templates de erro/timeout preenchendo apenas os campos variáveis"""
+    return shell_template.model_copy(update={
+        "id": next_uuid(),
+        "email": Email.model_construct(
+            id=next_uuid(),
+            content=request.content,
+            subject=request.subject,
+            sender=request.sender,
+            timestamp=cached_now()
+        ),
+        "suggestedResponse": response_template.model_copy(update={
+            "to": request.sender if request.sender else "cliente@email.com",
+            "subject": f"Re: {request.subject}" if request.subject else "Resposta"
+        }),
+        "processedAt": cached_now()
+    })
+
 @app.post("/classify-email", response_model=EmailClassificationResponse)
 async def classify_email(request: EmailRequest):
     try:
         logger.info("=== STARTING EMAIL CLASSIFICATION ===")
         logger.info(f"Subject: {request.subject}, Sender: {request.sender}")
 
-        email_id = str(uuid.uuid4())
-        classification_id = str(uuid.uuid4())
+        email_id = next_uuid()
+        classification_id = next_uuid()
 
         # Get company config if provided
         company_config_data = None
         if request.config_id:
-            company_config = company_service.get_config(request.config_id)
+            company_config = await company_service.get_config(request.config_id)
             if company_config:
                 logger.info(f"Using company config: {company_config.company_name}")
                 company_config_data = {
@@ -161,76 +390,69 @@ async def classify_email(request: EmailRequest):
             else:
                 logger.warning(f"Config ID {request.config_id} not found, using default")
 
-        classification_result = await asyncio.wait_for(
-            classifier.classify_and_respond(
+        # Conteúdo duplicado (retries, tickets reenviados) sai direto do cache
+        global _classification_cache_hits
+        cache_key = _classification_cache_key(request)
+        cached = _classification_cache.get(cache_key)
+        if cached is not None and time.monotonic() - cached['ts'] > _CLASSIFICATION_CACHE_TTL:
+            del _classification_cache[cache_key]
+            cached = None
+        if cached is not None:
+            _classification_cache.move_to_end(cache_key)
+            _classification_cache_hits += 1
+            logger.info("Classification served from cache")
+            classification_result = ClassificationResult.model_construct(
+                category=cached['category'],
+                reasoning=cached['reasoning'],
+                suggested_response=StructuredResponse.model_construct(**cached['suggested_response']),
+                classification_method=cached['classification_method']
+            )
+        else:
+            classification_result = await asyncio.wait_for(
+                classifier.classify_and_respond(
+                    content=request.content,
+                    subject=request.subject,
+                    sender=request.sender,
+                    company_config=company_config_data
+                ),
+                timeout=30.0
+            )
+            if classification_result.classification_method not in _NON_CACHEABLE_METHODS:
+                _classification_cache[cache_key] = {
+                    'category': classification_result.category,
+                    'reasoning': classification_result.reasoning,
+                    'suggested_response': classification_result.suggested_response.model_dump(),
+                    'classification_method': classification_result.classification_method,
+                    'ts': time.monotonic()
+                }
+                if len(_classification_cache) > _CLASSIFICATION_CACHE_SIZE:
+                    _classification_cache.popitem(last=False)
+
+        # Campos já validados na entrada/pelo classificador - pula revalidação
+        response = EmailClassificationResponse.model_construct(
+            id=classification_id,
+            email=Email.model_construct(
+                id=email_id,
                 content=request.content,
                 subject=request.subject,
                 sender=request.sender,
-                company_config=company_config_data
+                timestamp=cached_now()
             ),
-            timeout=30.0
-        )
-
-        response = EmailClassificationResponse(
-            id=classification_id,
-            email={
-                "id": email_id,
-                "content": request.content,
-                "subject": request.subject,
-                "sender": request.sender,
-                "timestamp": datetime.now()
-            },
             category=classification_result.category,
             reasoning=classification_result.reasoning,
             suggestedResponse=classification_result.suggested_response,
-            processedAt=datetime.now()
+            processedAt=cached_now()
         )
 
         return response
 
     except asyncio.TimeoutError:
         logger.error("Classification timed out")
-        from models.email_models import StructuredResponse
-        return EmailClassificationResponse(
-            id=str(uuid.uuid4()),
-            email={
-                "id": str(uuid.uuid4()),
-                "content": request.content,
-                "subject": request.subject,
-                "sender": request.sender,
-                "timestamp": datetime.now()
-            },
-            category="productive",
-            reasoning="Timeout no processamento - classificação padrão aplicada",
-            suggestedResponse=StructuredResponse(
-                to=request.sender if request.sender else "cliente@email.com",
-                subject=f"Re: {request.subject}" if request.subject else "Resposta",
-                body="Prezado(a),\n\nRecebemos sua mensagem e vamos analisá-la em breve.\n\nAtenciosamente,\nEquipe de Suporte"
-            ),
-            processedAt=datetime.now()
-        )
+        return _fallback_classification_response(_TIMEOUT_SHELL_TEMPLATE, _TIMEOUT_RESPONSE_TEMPLATE, request)
 
     except Exception as e:
         logger.error(f"Error: {e}")
-        from models.email_models import StructuredResponse
-        return EmailClassificationResponse(
-            id=str(uuid.uuid4()),
-            email={
-                "id": str(uuid.uuid4()),
-                "content": request.content,
-                "subject": request.subject,
-                "sender": request.sender,
-                "timestamp": datetime.now()
-            },
-            category="productive",
-            reasoning="Erro no processamento - classificação padrão aplicada",
-            suggestedResponse=StructuredResponse(
-                to=request.sender if request.sender else "cliente@email.com",
-                subject=f"Re: {request.subject}" if request.subject else "Resposta",
-                body="Prezado(a),\n\nRecebemos sua mensagem. Nossa equipe irá analisá-la e retornar em breve.\n\nAtenciosamente,\nEquipe de Suporte"
-            ),
-            processedAt=datetime.now()
-        )
+        return _fallback_classification_response(_ERROR_SHELL_TEMPLATE, _ERROR_RESPONSE_TEMPLATE, request)
 
 if __name__ == "__main__":
     import uvicorn
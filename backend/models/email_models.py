@@ -36,4 +36,8 @@ class ClassificationResult(BaseModel):
     """Internal model for classification result"""
     category: Literal['productive', 'unproductive']
     reasoning: str = Field(..., description="Explicação da classificação")
-    suggested_response: StructuredResponse
\ No newline at end of file
+    suggested_response: StructuredResponse
+    classification_method: str = Field(
+        default="unknown",
+        description="Caminho que produziu o resultado (AI+NLP, NLP_fast, NLP_fallback...)"
+    )
\ No newline at end of file
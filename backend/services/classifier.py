@@ -1,6 +1,6 @@
 import logging
 import asyncio
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 import re
 from .gemini_service import GeminiService
 from .nlp_preprocessor import NLPPreprocessor
@@ -9,6 +9,56 @@ from models.email_models import ClassificationResult
 
 logger = logging.getLogger(__name__)
 
+# Textos de reasoning indexados pelo rule_id devolvido por _classify_scores
+_FALLBACK_REASONINGS = (
+    'Email urgente detectado com contexto de negócios (urgência: {urgency:.1f})',
+    'Problema técnico identificado pelas features NLP (score: {technical:.2f})',
+    'Questão comercial identificada (score: {business:.2f})',
+    'Solicitação de suporte identificada (score: {support:.2f})',
+    'Mensagem social/pessoal sem contexto de negócios (score social: {social:.2f})',
+    'Múltiplas perguntas detectadas, indicando necessidade de suporte',
+    'Mensagem muito curta ({word_count} palavras) sem indicadores claros',
+    'Sem indicadores claros de necessidade de ação (análise NLP conservadora)',
+)
+
+def _classify_scores(
+    technical: float,
+    business: float,
+    support: float,
+    social: float,
+    urgency: float,
+    has_multiple_questions: bool,
+    word_count: int,
+) -> Tuple[str, str, int]:
+    """
+    Cascata de thresholds do fallback como função pura sobre floats.
+    Retorna (category, confidence, rule_id); o texto do reasoning fica
+    em Python via _FALLBACK_REASONINGS[rule_id].
+    """
+    # Urgência alta + contexto de negócios
+    if urgency > 0.5 and (technical > 0.2 or business > 0.2):
+        return 'productive', 'high', 0
+    # Score técnico alto = productive
+    if technical > 0.4:
+        return 'productive', 'high', 1
+    # Score de negócio alto = productive
+    if business > 0.4:
+        return 'productive', 'high', 2
+    # Score de suporte alto = productive
+    if support > 0.4:
+        return 'productive', 'medium', 3
+    # Score social alto + outros baixos = unproductive
+    if social > 0.4 and technical < 0.1 and business < 0.1:
+        return 'unproductive', 'high', 4
+    # Múltiplas perguntas + baixo score social = productive (likely dúvidas)
+    if has_multiple_questions and social < 0.2:
+        return 'productive', 'medium', 5
+    # Mensagem muito curta sem contexto claro
+    if word_count < 10:
+        return 'unproductive', 'medium', 6
+    # Default conservador - se não há indicadores claros
+    return 'unproductive', 'low', 7
+
 class EmailClassifier:
     """
     Serviço de classificação de emails que determina se são produtivos ou improdutivos
@@ -17,39 +67,92 @@ class EmailClassifier:
     Agora com camada de NLP para pré-processamento e extração de features.
     """
     
-    def __init__(self):
+    def __init__(self, nlp_fast_threshold: float = 0.6):
         self.ai_service = GeminiService()
         self.nlp_preprocessor = NLPPreprocessor()
         self.feature_extractor = TextFeatureExtractor()
+        # Acima deste score nas features, a classificação IA nem é consultada
+        self.nlp_fast_threshold = nlp_fast_threshold
         logger.info("[CLASSIFIER] Initialized with AI-first approach + NLP enrichment")
     
+    def analyze(self, content: str, subject: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Executa pré-processamento e extração de features em uma passada
+        compartilhada: as estruturas já extraídas (urls, emails, phones)
+        são repassadas ao extractor em vez de varrer o texto novamente.
+        """
+        preprocessed = self.nlp_preprocessor.preprocess(content, remove_stopwords=False)
+        features = self.feature_extractor.extract_all_features(
+            content, subject, metadata=preprocessed.get('metadata')
+        )
+        return {'preprocessed': preprocessed, 'features': features}
+
+    def _nlp_fast_category(self, features: Dict[str, Any]) -> Optional[str]:
+        """
+        Categoria inequívoca só pelas features NLP, ou None quando a IA deve
+        decidir. Usada para responder sem nenhuma chamada de classificação IA.
+        """
+        technical = features.get('technical_score', 0.0)
+        business = features.get('business_score', 0.0)
+        support = features.get('support_score', 0.0)
+        social = features.get('social_score', 0.0)
+        best = max(technical, business, support, social)
+        if best <= self.nlp_fast_threshold:
+            return None
+        if social == best:
+            # Urgência ou contexto de negócios/suporte contradiz email
+            # puramente social — deixa a IA decidir
+            if (features.get('urgency_score', 0.0) > 0.5
+                    or technical > 0.2 or business > 0.2 or support > 0.2):
+                return None
+            return 'unproductive'
+        return 'productive'
+
+    def _speculative_category(self, features: Dict[str, Any]) -> Optional[str]:
+        """
+        Categoria provável quando as features dão um sinal forte — usada para
+        gerar a resposta especulativamente em paralelo com a classificação IA
+        """
+        if (features.get('technical_score', 0.0) > 0.4
+                or features.get('business_score', 0.0) > 0.4
+                or features.get('support_score', 0.0) > 0.4):
+            return 'productive'
+        if features.get('social_score', 0.0) > 0.4:
+            return 'unproductive'
+        # Urgência alta sem categoria clara: a regra do prompt já manda
+        # tratar urgente-sobre-a-empresa como produtivo, então vale especular
+        if features.get('urgency_score', 0.0) > 0.5:
+            return 'productive'
+        return None
+
     async def classify_and_respond(
-        self, 
-        content: str, 
-        subject: Optional[str] = None, 
+        self,
+        content: str,
+        subject: Optional[str] = None,
         sender: Optional[str] = None,
         company_config: Optional[Dict[str, str]] = None
     ) -> ClassificationResult:
         """
         Classifica o email usando IA (método principal) com fallback enriquecido por NLP
         """
+        speculative_task = None
+        speculative_category = None
         try:
-            logger.info(f"━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
-            logger.info(f"[CLASSIFIER] Starting classification with NLP")
-            logger.info(f"[CLASSIFIER] Content preview: {content[:150]}...")
-            logger.info(f"[CLASSIFIER] Subject: '{subject}'")
-            logger.info(f"[CLASSIFIER] Sender: '{sender}'")
-            logger.info(f"━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
-            
+            # Logs verbosos só em DEBUG: o slice do conteúdo nem é feito se o
+            # nível estiver desligado
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[CLASSIFIER] Starting classification with NLP: subject=%r sender=%r preview=%r",
+                             subject, sender, content[:150])
+
             # ===== NLP PRÉ-PROCESSAMENTO =====
-            logger.info("[NLP STEP] Preprocessing text...")
-            preprocessed = self.nlp_preprocessor.preprocess(content, remove_stopwords=False)
-            features = self.feature_extractor.extract_all_features(content, subject)
-            
-            logger.info(f"[NLP STEP] ✅ Preprocessing complete:")
-            logger.info(f"  - Keywords found: {preprocessed['metadata'].get('keywords', [])}")
-            logger.info(f"  - Urgency detected: {preprocessed['metadata'].get('has_urgency', False)}")
-            logger.info(f"  - Feature-based hint: {features.get('feature_based_category', 'uncertain')}")
+            analysis = self.analyze(content, subject)
+            preprocessed = analysis['preprocessed']
+            features = analysis['features']
+
+            logger.debug("[NLP STEP] Preprocessing complete: keywords=%s urgency=%s hint=%s",
+                         preprocessed['metadata'].get('keywords', []),
+                         preprocessed['metadata'].get('has_urgency', False),
+                         features.get('feature_based_category', 'uncertain'))
             
             final_category = "unproductive"  # Conservative default
             final_reasoning = "Classificação padrão por segurança"
@@ -57,51 +160,82 @@ class EmailClassifier:
             confidence = "low"
             
             
-            logger.info("[CLASSIFIER STEP 1] Attempting AI classification with NLP-cleaned text...")
-            try:
-              
-                cleaned_content = preprocessed['cleaned_text']
-                
-                ai_result = await asyncio.wait_for(
-                    self.ai_service.classify_email_with_context(cleaned_content, subject, company_config),
-                    timeout=15.0
+            # Sinal forte nas features → já dispara a geração de resposta em
+            # paralelo com a classificação; as duas chamadas à IA se sobrepõem
+            speculative_category = self._speculative_category(features)
+            if speculative_category:
+                logger.debug("[CLASSIFIER SPECULATIVE] Pre-generating response for likely category: %s", speculative_category)
+                speculative_task = asyncio.create_task(
+                    self._generate_response(content, speculative_category, subject, sender, company_config)
                 )
-                final_category = ai_result.get('category', 'unproductive')
-                final_reasoning = ai_result.get('reasoning', 'Classificação por IA')
-                confidence = ai_result.get('confidence', 'medium')
-                classification_method = "AI+NLP"
-                logger.info(f"[CLASSIFIER STEP 1] ✅ AI Success: category={final_category}, confidence={confidence}")
-                logger.info(f"[CLASSIFIER STEP 1] Reasoning: {final_reasoning}")
-            except asyncio.TimeoutError:
-                logger.warning(f"[CLASSIFIER STEP 1] ⏱️ AI classification TIMEOUT after 15s")
-                
-                fallback_result = self._nlp_enhanced_fallback(content, subject, features)
-                final_category = fallback_result['category']
-                final_reasoning = fallback_result['reasoning']
-                confidence = fallback_result['confidence']
-                classification_method = "NLP_fallback"
-                logger.info(f"[CLASSIFIER STEP 2] 🔄 NLP-enhanced fallback: {final_category} (confidence: {confidence})")
-            except Exception as ai_error:
-                logger.warning(f"[CLASSIFIER STEP 1] ⚠️ AI classification ERROR: {str(ai_error)}")
-                
-                fallback_result = self._nlp_enhanced_fallback(content, subject, features)
-                final_category = fallback_result['category']
-                final_reasoning = fallback_result['reasoning']
-                confidence = fallback_result['confidence']
-                classification_method = "NLP_fallback"
-                logger.info(f"[CLASSIFIER STEP 2] 🔄 NLP-enhanced fallback: {final_category} (confidence: {confidence})")
+
+            # Atalho NLP: sinal inequívoco nas features dispensa a chamada de
+            # classificação à IA — só a geração de resposta continua com ela
+            fast_category = self._nlp_fast_category(features)
+            if fast_category:
+                final_category = fast_category
+                final_reasoning = (
+                    f'Features NLP com sinal inequívoco para {fast_category} '
+                    f'(acima do threshold {self.nlp_fast_threshold})'
+                )
+                confidence = "high"
+                classification_method = "NLP_fast"
+                logger.debug("[CLASSIFIER STEP 1] NLP fast path: %s (AI classification skipped)", final_category)
+            else:
+                logger.debug("[CLASSIFIER STEP 1] Attempting AI classification with NLP-cleaned text...")
+                try:
+
+                    cleaned_content = preprocessed['cleaned_text']
+
+                    ai_result = await asyncio.wait_for(
+                        self.ai_service.classify_email_with_context(cleaned_content, subject, company_config),
+                        timeout=15.0
+                    )
+                    final_category = ai_result.get('category', 'unproductive')
+                    final_reasoning = ai_result.get('reasoning', 'Classificação por IA')
+                    confidence = ai_result.get('confidence', 'medium')
+                    classification_method = "AI+NLP"
+                    logger.debug("[CLASSIFIER STEP 1] AI Success: category=%s, confidence=%s, reasoning=%s",
+                                 final_category, confidence, final_reasoning)
+                except asyncio.TimeoutError:
+                    logger.warning("[CLASSIFIER STEP 1] AI classification TIMEOUT after 15s")
+
+                    fallback_result = self._nlp_enhanced_fallback(content, subject, features)
+                    final_category = fallback_result['category']
+                    final_reasoning = fallback_result['reasoning']
+                    confidence = fallback_result['confidence']
+                    classification_method = "NLP_fallback"
+                    logger.info("[CLASSIFIER STEP 2] NLP-enhanced fallback: %s (confidence: %s)", final_category, confidence)
+                except Exception as ai_error:
+                    logger.warning("[CLASSIFIER STEP 1] AI classification ERROR: %s", ai_error)
+
+                    fallback_result = self._nlp_enhanced_fallback(content, subject, features)
+                    final_category = fallback_result['category']
+                    final_reasoning = fallback_result['reasoning']
+                    confidence = fallback_result['confidence']
+                    classification_method = "NLP_fallback"
+                    logger.info("[CLASSIFIER STEP 2] NLP-enhanced fallback: %s (confidence: %s)", final_category, confidence)
             
             
-            logger.info(f"[CLASSIFIER STEP 3] Generating response for category: {final_category}")
+            logger.debug("[CLASSIFIER STEP 3] Generating response for category: %s", final_category)
             structured_response = None
             try:
-                structured_response = await asyncio.wait_for(
-                    self._generate_response(content, final_category, subject, sender, company_config),
-                    timeout=20.0
-                )
-                logger.info(f"[CLASSIFIER STEP 3] ✅ Response generated successfully")
+                if speculative_task is not None and final_category == speculative_category:
+                    # A especulação acertou: aproveita a resposta já em andamento
+                    # (shield evita cancelamento torto se o wait_for estourar)
+                    structured_response = await asyncio.wait_for(asyncio.shield(speculative_task), timeout=20.0)
+                    logger.debug("[CLASSIFIER STEP 3] Speculative response used (saved one serialized AI call)")
+                else:
+                    if speculative_task is not None:
+                        speculative_task.cancel()
+                        logger.debug("[CLASSIFIER SPECULATIVE] Prediction missed (%s != %s), regenerating", speculative_category, final_category)
+                    structured_response = await asyncio.wait_for(
+                        self._generate_response(content, final_category, subject, sender, company_config),
+                        timeout=20.0
+                    )
+                    logger.debug("[CLASSIFIER STEP 3] Response generated successfully")
             except Exception as response_error:
-                logger.warning(f"[CLASSIFIER STEP 3] ⚠️ Response generation failed: {str(response_error)}")
+                logger.warning("[CLASSIFIER STEP 3] Response generation failed: %s", response_error)
                 
                 if final_category == "productive":
                     body = "Prezado(a),\n\nRecebemos sua mensagem e nossa equipe irá analisá-la. Retornaremos o contato em breve.\n\nAtenciosamente,\nEquipe de Suporte"
@@ -118,34 +252,32 @@ class EmailClassifier:
             result = ClassificationResult(
                 category=final_category,
                 reasoning=final_reasoning,
-                suggested_response=structured_response
+                suggested_response=structured_response,
+                classification_method=classification_method
             )
             
-            logger.info(f"━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
-            logger.info(f"[CLASSIFIER] ✅ COMPLETED SUCCESSFULLY")
-            logger.info(f"[CLASSIFIER] Result: {result.category} (method: {classification_method}, confidence: {confidence})")
-            logger.info(f"[CLASSIFIER] Reasoning: {final_reasoning}")
-            logger.info(f"━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
+            logger.info("[CLASSIFIER] Completed: %s (method: %s, confidence: %s)",
+                        result.category, classification_method, confidence)
+            logger.debug("[CLASSIFIER] Reasoning: %s", final_reasoning)
             
             return result
             
         except Exception as e:
-            logger.error(f"━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
-            logger.error(f"[CLASSIFIER] ❌ CRITICAL ERROR")
-            logger.error(f"[CLASSIFIER] Error message: {str(e)}")
-            logger.error(f"[CLASSIFIER] Error type: {type(e).__name__}")
-            logger.error(f"━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
+            if speculative_task is not None and not speculative_task.done():
+                speculative_task.cancel()
+            logger.error("[CLASSIFIER] CRITICAL ERROR: %s (%s)", e, type(e).__name__)
             raise Exception(f"Email Classification Service failed: {str(e)}")
     
-    def _nlp_enhanced_fallback(self, content: str, subject: Optional[str] = None, features: Dict[str, Any] = None) -> Dict[str, Any]:
+    def _nlp_enhanced_fallback(self, content: str, subject: Optional[str] = None, features: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """
         Fallback ENRIQUECIDO com features NLP quando a IA falha
         Usa scores de features para melhor classificação
         """
         text = f"{subject or ''} {content}".lower().strip()
         
-        logger.info(f"[NLP FALLBACK] Analyzing with extracted features...")
-        
+        logger.debug("[NLP FALLBACK] Analyzing with extracted features...")
+
+        # Só recomputa se o chamador não tinha as features em mãos
         if features is None:
             features = self.feature_extractor.extract_all_features(content, subject)
         
@@ -156,71 +288,34 @@ class EmailClassifier:
         social_score = features.get('social_score', 0.0)
         urgency_score = features.get('urgency_score', 0.0)
         
-        logger.info(f"[NLP FALLBACK] Scores: tech={technical_score:.2f}, biz={business_score:.2f}, "
-                   f"support={support_score:.2f}, social={social_score:.2f}, urgency={urgency_score:.2f}")
-        
-       
-        if urgency_score > 0.5 and (technical_score > 0.2 or business_score > 0.2):
-            return {
-                'category': 'productive',
-                'reasoning': f'Email urgente detectado com contexto de negócios (urgência: {urgency_score:.1f})',
-                'confidence': 'high'
-            }
-        
-        # Score técnico alto = productive
-        if technical_score > 0.4:
-            return {
-                'category': 'productive',
-                'reasoning': f'Problema técnico identificado pelas features NLP (score: {technical_score:.2f})',
-                'confidence': 'high'
-            }
-        
-        # Score de negócio alto = productive
-        if business_score > 0.4:
-            return {
-                'category': 'productive',
-                'reasoning': f'Questão comercial identificada (score: {business_score:.2f})',
-                'confidence': 'high'
-            }
-        
-        # Score de suporte alto = productive
-        if support_score > 0.4:
-            return {
-                'category': 'productive',
-                'reasoning': f'Solicitação de suporte identificada (score: {support_score:.2f})',
-                'confidence': 'medium'
-            }
-        
-        # Score social alto + outros baixos = unproductive
-        if social_score > 0.4 and technical_score < 0.1 and business_score < 0.1:
-            return {
-                'category': 'unproductive',
-                'reasoning': f'Mensagem social/pessoal sem contexto de negócios (score social: {social_score:.2f})',
-                'confidence': 'high'
-            }
-        
-        # Múltiplas perguntas + baixo score social = productive (likely dúvidas)
-        if features.get('has_multiple_questions', False) and social_score < 0.2:
-            return {
-                'category': 'productive',
-                'reasoning': 'Múltiplas perguntas detectadas, indicando necessidade de suporte',
-                'confidence': 'medium'
-            }
-        
-        # Mensagem muito curta sem contexto claro
-        if features.get('word_count', 0) < 10:
-            return {
-                'category': 'unproductive',
-                'reasoning': f'Mensagem muito curta ({features.get("word_count", 0)} palavras) sem indicadores claros',
-                'confidence': 'medium'
-            }
-        
-        # Default conservador - se não há indicadores claros
-        logger.info(f"[NLP FALLBACK] No clear indicators, defaulting to unproductive")
+        logger.debug("[NLP FALLBACK] Scores: tech=%.2f, biz=%.2f, support=%.2f, social=%.2f, urgency=%.2f",
+                     technical_score, business_score, support_score, social_score, urgency_score)
+
+        word_count = features.get('word_count', 0)
+        category, confidence, rule_id = _classify_scores(
+            technical_score,
+            business_score,
+            support_score,
+            social_score,
+            urgency_score,
+            features.get('has_multiple_questions', False),
+            word_count
+        )
+
+        if rule_id == 7:
+            logger.debug("[NLP FALLBACK] No clear indicators, defaulting to unproductive")
+
         return {
-            'category': 'unproductive',
-            'reasoning': 'Sem indicadores claros de necessidade de ação (análise NLP conservadora)',
-            'confidence': 'low'
+            'category': category,
+            'reasoning': _FALLBACK_REASONINGS[rule_id].format(
+                urgency=urgency_score,
+                technical=technical_score,
+                business=business_score,
+                support=support_score,
+                social=social_score,
+                word_count=word_count
+            ),
+            'confidence': confidence
         }
     
     def _critical_fallback_classification(self, content: str, subject: Optional[str] = None) -> Dict[str, Any]:
@@ -248,10 +343,10 @@ class EmailClassifier:
                 body=response_dict["body"]
             )
             
-            logger.info(f"AI structured response generated successfully for {category} email")
+            logger.debug("AI structured response generated successfully for %s email", category)
             return structured_response
             
         except Exception as e:
-            logger.error(f"Error generating AI response: {str(e)}")
+            logger.error("Error generating AI response: %s", e)
             raise Exception("AI Response Generation falhou")
     
\ No newline at end of file
@@ -1,33 +1,84 @@
+import os
 import uuid
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, Optional
+from functools import lru_cache
+from typing import Optional
 from models.company_models import CompanyConfig, CompanyConfigRequest
 
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # redis é opcional - sem ele o armazenamento fica em memória
+    aioredis = None
+
 class CompanyService:
     """Service for managing company configurations"""
-    
+
+    # Limite de configurações mantidas em memória (evita crescimento sem fim)
+    MAX_CONFIGS = 10_000
+
+    # TTL das configs no Redis (30 dias)
+    CONFIG_TTL = 30 * 24 * 60 * 60
+
     def __init__(self):
-        
-        self._configs: Dict[str, CompanyConfig] = {}
-    
-    def create_config(self, request: CompanyConfigRequest) -> CompanyConfig:
+        # OrderedDict como LRU: acessos movem para o fim, excedentes saem do início
+        self._configs: "OrderedDict[str, CompanyConfig]" = OrderedDict()
+        # Memoiza os últimos lookups quentes; invalidado a cada escrita
+        self._get_cached = lru_cache(maxsize=128)(self._lookup_config)
+        # Backend Redis opcional (REDIS_URL): torna as configs visíveis entre
+        # workers do uvicorn; sem ele o LRU local continua valendo
+        redis_url = os.environ.get("REDIS_URL")
+        self._redis = aioredis.from_url(redis_url) if (aioredis and redis_url) else None
+
+    async def create_config(self, request: CompanyConfigRequest) -> CompanyConfig:
         """Create a new company configuration"""
-        config_id = str(uuid.uuid4())[:8].upper()  
-        
+        config_id = str(uuid.uuid4())[:8].upper()
+
         config = CompanyConfig(
             config_id=config_id,
             company_name=request.company_name,
             custom_instructions=request.custom_instructions,
             created_at=datetime.now()
         )
-        
-        self._configs[config_id] = config
+
+        self._store_local(config)
+        if self._redis is not None:
+            await self._redis.set(f"cfg:{config_id}", config.model_dump_json(), ex=self.CONFIG_TTL)
         return config
-    
-    def get_config(self, config_id: str) -> Optional[CompanyConfig]:
+
+    def _store_local(self, config: CompanyConfig):
+        """Guarda no LRU local, descartando a entrada mais antiga se necessário"""
+        self._configs[config.config_id] = config
+        if len(self._configs) > self.MAX_CONFIGS:
+            self._configs.popitem(last=False)
+        self._get_cached.cache_clear()
+
+    def _lookup_config(self, config_id: str) -> Optional[CompanyConfig]:
+        """Busca no LRU local, renovando a posição em caso de hit"""
+        config = self._configs.get(config_id)
+        if config is not None:
+            self._configs.move_to_end(config_id)
+        return config
+
+    async def get_config(self, config_id: str) -> Optional[CompanyConfig]:
         """Get a company configuration by ID"""
-        return self._configs.get(config_id)
-    
-    def config_exists(self, config_id: str) -> bool:
+        config = self._get_cached(config_id)
+        if config is not None or self._redis is None:
+            return config
+
+        # Miss local: pode ter sido criada em outro worker
+        raw = await self._redis.get(f"cfg:{config_id}")
+        if raw is None:
+            return None
+        config = CompanyConfig.model_validate_json(raw)
+        # Povoa o LRU local para amortizar o RTT do Redis nos próximos hits
+        self._store_local(config)
+        return config
+
+    async def config_exists(self, config_id: str) -> bool:
         """Check if a configuration exists"""
-        return config_id in self._configs
+        if config_id in self._configs:
+            return True
+        if self._redis is not None:
+            return bool(await self._redis.exists(f"cfg:{config_id}"))
+        return False
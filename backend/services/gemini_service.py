@@ -1,25 +1,290 @@
 import aiohttp
 import asyncio
+import hashlib
 import logging
 import os
+import random
+import re
+import sys
+from collections import OrderedDict, deque
+from functools import lru_cache
 from typing import Dict, Any, Optional
-import json
+import orjson
+import string
 import time
 
+from services.semantic_cache import SemanticCache
+
+try:
+    import ijson
+except ImportError:  # ijson é opcional - sem ele a resposta é parseada inteira
+    ijson = None
+
 logger = logging.getLogger(__name__)
 
+
+class _TeeStream:
+    """
+    Espelha os bytes que o parser incremental consome do stream: se o
+    functionCall não aparecer, o corpo inteiro já está em `buffer` para
+    o fallback bufferizado reparsear sem segunda leitura da rede.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.buffer = bytearray()
+
+    async def read(self, n: int) -> bytes:
+        chunk = await self._stream.read(n)
+        self.buffer.extend(chunk)
+        return chunk
+
+# Padrões usados na extração de remetente/assinatura, compilados uma única vez
+_EMAIL_RE = re.compile(r'([a-zA-Z0-9._-]+@[a-zA-Z0-9._-]+\.[a-zA-Z0-9_-]+)')
+_SIG_RE = re.compile(
+    r'(?:Atenciosamente|Cordialmente|Abraços|At\.te)[,\s]*\n+'
+    r'([A-ZÁÉÍÓÚÂÊÔÃÕÇ][a-záéíóúâêôãõç]+(?:\s+[A-ZÁÉÍÓÚÂÊÔÃÕÇ][a-záéíóúâêôãõç]+)+)',
+    re.IGNORECASE
+)
+_ROLE_NOISE_RE = re.compile(r'[@\d\(\)]')
+
+# Linhas de citação/cabeçalho de reply que só gastam orçamento de tokens
+_QUOTE_HEADER_RE = re.compile(r'^(?:On .+ wrote:|Em .+ escreveu:)\s*$')
+_SIG_CLOSE_RE = re.compile(r'^(?:Atenciosamente|Cordialmente|Abraços|At\.te)[,.]?\s*$', re.IGNORECASE)
+_MULTI_NEWLINE_RE = re.compile(r'\n{3,}')
+
+# Objeto JSON dentro da resposta (com ou sem cercas ```/prosa em volta)
+_JSON_BLOCK = re.compile(r'\{.*\}', re.DOTALL)
+
+
+def _clean_email_text(text: str) -> str:
+    """
+    Remove cadeias de reply citadas e o rodapé da assinatura antes do
+    truncamento: são os trechos que mais consomem tokens com sinal quase
+    nulo. O fecho da assinatura e a linha do nome são preservados (a
+    extração de remetente depende deles); telefones/disclaimers caem fora.
+    """
+    lines = []
+    for line in text.split('\n'):
+        stripped = line.lstrip()
+        if stripped.startswith('>') or _QUOTE_HEADER_RE.match(stripped):
+            continue
+        lines.append(line)
+
+    for i, line in enumerate(lines):
+        if _SIG_CLOSE_RE.match(line.strip()):
+            lines = lines[:i + 2]
+            break
+
+    return _MULTI_NEWLINE_RE.sub('\n\n', '\n'.join(lines)).strip()
+
+
+@lru_cache(maxsize=256)
+def _role_re_for(sender_name: str) -> "re.Pattern":
+    """Compila (e memoiza) o padrão de cargo logo abaixo do nome do remetente"""
+    name_pattern = re.escape(sender_name)
+    return re.compile(
+        rf'{name_pattern}\s*\n\s*'
+        r'([A-ZÁÉÍÓÚÂÊÔÃÕÇ][a-záéíóúâêôãõç\s]+(?:de|da|do)\s+[A-ZÁÉÍÓÚÂÊÔÃÕÇ][a-záéíóúâêôãõç]+'
+        r'|[A-ZÁÉÍÓÚÂÊÔÃÕÇ][a-záéíóúâêôãõç\s]+)'
+    )
+
+# Regras de classificação compartilhadas entre o prompt individual e o de lote
+_CLASSIFY_RULES = """PRODUTIVO = Email relacionado aos NEGÓCIOS da empresa:
+• Dúvidas sobre produtos/serviços
+• Problemas técnicos ou bugs
+• Solicitações de suporte ou informações
+• Reclamações sobre serviços
+• Questões comerciais (preços, contratos)
+• Perguntas sobre a empresa (localização, horários, etc)
+
+IMPRODUTIVO = Email pessoal/social SEM relação com negócios:
+• Agradecimentos, gratificações, felicitações, convites são considerados pessoais/sociais
+• Perguntas pessoais sobre funcionários
+• Saudações sociais puras sem contexto
+• Spam ou marketing externo
+• Conversas casuais
+• Promoções, atualizações de serviços que não tem haver com uma empresa de tecnologia
+
+REGRAS: Se o email pergunta ALGO SOBRE A EMPRESA OU SEUS SERVIÇOS → PRODUTIVO / SE O EMAIL FOR URGENTE SOBRE ALGO DA EMPRESA -> PRODUTIVO"""
+
+# Schema de uma classificação (reutilizado como item no tool-calling em lote)
+_CLASSIFY_PARAMETERS = {
+    "type": "object",
+    "properties": {
+        "category": {
+            "type": "string",
+            "enum": ["productive", "unproductive"],
+            "description": "Categoria do email"
+        },
+        "issue_type": {
+            "type": "string",
+            "description": "Tipo de questão identificada (ex: 'problema técnico', 'dúvida comercial', 'conversa pessoal', 'spam')"
+        },
+        "reasoning": {
+            "type": "string",
+            "description": "Explicação específica (mínimo 30 palavras) do POR QUÊ é produtivo ou improdutivo. Deve identificar claramente o que torna este email relacionado ou não aos negócios da empresa."
+        },
+        "confidence": {
+            "type": "string",
+            "enum": ["high", "medium", "low"],
+            "description": "Confiança na classificação"
+        }
+    },
+    "required": ["category", "issue_type", "reasoning", "confidence"]
+}
+
+# Prompts montados uma única vez na carga do módulo: por chamada só os campos
+# variáveis (assunto/conteúdo/remetente) são substituídos, sem reconstruir a
+# parte estática de ~2KB a cada request. O prefixo estático fica separado do
+# rabo variável para poder ser registrado no cachedContents da API (aí cada
+# request envia só o rabo)
+_CLASSIFY_PROMPT_PREFIX = f"""Classifique este email como PRODUTIVO ou IMPRODUTIVO.
+
+{_CLASSIFY_RULES}
+
+"""
+
+_CLASSIFY_PROMPT_TAIL_TEMPLATE = string.Template("""
+EMAIL:
+Assunto: ${subject}
+Conteúdo: ${content}
+
+Identifique o tipo de questão (ex: "problema técnico", "dúvida comercial", "conversa pessoal") e explique POR QUE é produtivo ou improdutivo em 2-3 frases claras.""")
+
+_CLASSIFY_PROMPT_TEMPLATE = string.Template(_CLASSIFY_PROMPT_PREFIX + _CLASSIFY_PROMPT_TAIL_TEMPLATE.template)
+
+_CLASSIFY_BATCH_PROMPT_TEMPLATE = string.Template(f"""Classifique cada um dos ${{count}} emails abaixo como PRODUTIVO ou IMPRODUTIVO.
+
+{_CLASSIFY_RULES}
+
+
+${{sections}}
+
+Para cada email, identifique o tipo de questão e explique POR QUE é produtivo ou improdutivo em 2-3 frases claras. Retorne as classificações na MESMA ORDEM dos emails.""")
+
+_UNPRODUCTIVE_PROMPT_TEMPLATE = string.Template("""Você é um assistente profissional da empresa ${company_name}.
+
+CATEGORIA: Email social/pessoal (IMPRODUTIVO)
+
+CONTEXTO DO EMAIL RECEBIDO:
+${context}
+
+REMETENTE: ${sender_context}
+ASSUNTO: ${subject}
+
+INSTRUÇÕES PARA RESPOSTA:
+1. Leia o contexto do email e identifique o tipo de mensagem (agradecimento, convite, felicitação, etc)
+2. Crie uma resposta BREVE (2-4 linhas) e personalizada para o contexto específico
+3. Seja cordial mas profissional
+4. VARIE o texto - não use sempre a mesma resposta genérica
+5. SEMPRE termine com: "Atenciosamente,\\n${company_name}"${custom_instructions}
+
+EXEMPLO DE VARIAÇÃO:
+- Para agradecimento: agradeça de volta e deseje sucesso
+- Para convite: agradeça pelo convite e responda educadamente
+- Para felicitação: agradeça e retribua os votos
+- Para mensagem genérica: seja cordial mas objetivo
+
+Gere APENAS um JSON válido com uma resposta personalizada:
+{
+  "to": "${recipient}",
+  "subject": "${response_subject}",
+  "body": "[GERE RESPOSTA CURTA PERSONALIZADA BASEADA NO CONTEXTO]"
+}""")
+
+_PRODUCTIVE_PROMPT_TEMPLATE = string.Template("""Você é um assistente profissional da empresa ${company_name}.
+
+CATEGORIA: Email de negócios (PRODUTIVO)
+
+CONTEXTO DO EMAIL RECEBIDO:
+${context}
+
+REMETENTE: ${sender_context}
+ASSUNTO: ${subject}
+
+INSTRUÇÕES PARA RESPOSTA:
+1. Analise o tipo de solicitação (problema técnico, dúvida comercial, suporte, etc)
+2. Seja ESPECÍFICO - mencione detalhes do problema/questão do remetente
+3. Ofereça solução clara ou próximos passos
+4. Use tom profissional mas acessível
+5. VARIE a resposta baseada no contexto - não use template genérico
+6. SEMPRE termine com: "Atenciosamente,\\n${company_name}"${custom_instructions}
+
+EXEMPLOS DE VARIAÇÃO:
+- Problema técnico: reconheça o problema específico + ofereça solução ou investigação
+- Dúvida comercial: responda a pergunta específica + ofereça mais informações se necessário
+- Suporte geral: responda a questão + indique canal apropriado se necessário
+
+Gere APENAS um JSON válido com resposta personalizada e específica:
+{
+  "to": "${recipient}",
+  "subject": "${response_subject}",
+  "body": "[GERE RESPOSTA DETALHADA E ESPECÍFICA BASEADA NO CONTEXTO]"
+}""")
+
+# Respostas locais para emails improdutivos triviais: agradecimentos, convites
+# e felicitações recebem uma variante pronta (sem chamada ao Gemini); só o que
+# não casa com nenhum conjunto de palavras-chave segue para a API
+_UNPRODUCTIVE_KEYWORDS = {
+    'thanks': ('obrigado', 'obrigada', 'agradeço', 'agradecemos', 'grato', 'grata'),
+    'invite': ('convite', 'convidar', 'convidamos'),
+    'congrats': ('parabéns', 'felicitações', 'feliz natal', 'feliz ano', 'boas festas'),
+}
+
+_UNPRODUCTIVE_TEMPLATES = {
+    'thanks': (
+        "{greeting},\n\nNós que agradecemos o seu contato! Ficamos muito felizes em poder ajudar.\n\nAtenciosamente,\n{company_name}",
+        "{greeting},\n\nMuito obrigado pela sua mensagem! É um prazer contar com você.\n\nAtenciosamente,\n{company_name}",
+        "{greeting},\n\nAgradecemos as suas palavras! Seguimos à disposição sempre que precisar.\n\nAtenciosamente,\n{company_name}",
+    ),
+    'invite': (
+        "{greeting},\n\nAgradecemos o convite! Vamos verificar a disponibilidade e retornamos em breve.\n\nAtenciosamente,\n{company_name}",
+        "{greeting},\n\nMuito obrigado pelo convite, ficamos honrados com a lembrança!\n\nAtenciosamente,\n{company_name}",
+        "{greeting},\n\nQue gentileza o convite! Agradecemos a consideração.\n\nAtenciosamente,\n{company_name}",
+    ),
+    'congrats': (
+        "{greeting},\n\nMuito obrigado pelas felicitações! Desejamos o mesmo a você.\n\nAtenciosamente,\n{company_name}",
+        "{greeting},\n\nAgradecemos os votos e retribuímos com muito carinho!\n\nAtenciosamente,\n{company_name}",
+        "{greeting},\n\nFicamos felizes com a sua mensagem! Retribuímos os votos.\n\nAtenciosamente,\n{company_name}",
+    ),
+}
+
 class GeminiService:
     """Service for interacting with Google AI Studio (Gemini API)"""
-    
+
+    # Sem __dict__: acesso a atributo vira offset fixo (caminho quente lê
+    # model/api_key/base_url a cada chamada) e a instância fica menor
+    __slots__ = (
+        'base_url', 'model', 'fallback_model',
+        'circuit_breaker_errors', 'circuit_breaker_threshold',
+        'circuit_breaker_timeout', 'circuit_open_until',
+        'api_key',
+        'batch_max_size', 'batch_window', '_batch_queue', '_batcher_task',
+        '_session',
+        '_response_cache', '_response_cache_max', '_response_cache_ttl',
+        '_response_cache_lock',
+        '_semantic_cache',
+        '_tool_gen_config', '_tool_payload_cache',
+        '_generate_url', '_fallback_generate_url', '_base_headers',
+        '_cached_content_name', '_cached_content_task',
+        '_loop_configured',
+    )
+
+    # TTL do prefixo registrado no cachedContents da API (renovado antes)
+    _CACHED_CONTENT_TTL = 3600
+
+
     def __init__(self):
         self.base_url = "https://generativelanguage.googleapis.com/v1beta/models"
         self.model = "gemini-2.5-flash-lite"  
         self.fallback_model = "gemini-2.5-flash-lite"  
         
 
-        self.circuit_breaker_errors = []
-        self.circuit_breaker_threshold = 3  
-        self.circuit_breaker_timeout = 45  
+        self.circuit_breaker_threshold = 3
+        self.circuit_breaker_timeout = 45
+        # deque limitado: descartar erros antigos é O(1), sem realocar lista
+        self.circuit_breaker_errors = deque(maxlen=self.circuit_breaker_threshold * 4)
         self.circuit_open_until = 0
         
 
@@ -27,94 +292,379 @@ class GeminiService:
         if not gemini_key:
             raise ValueError("GEMINI_API_KEY environment variable is required")
         self.api_key = gemini_key
-    
+
+        # URLs e headers prontos: nada de f-string por chamada; a chave vai
+        # no header x-goog-api-key (e some de qualquer log de URL)
+        self._generate_url = f"{self.base_url}/{self.model}:generateContent"
+        self._fallback_generate_url = f"{self.base_url}/{self.fallback_model}:generateContent"
+        self._base_headers = {
+            "Content-Type": "application/json",
+            "x-goog-api-key": self.api_key
+        }
+
+        # Micro-batching: classificações que chegam dentro da janela são
+        # agrupadas numa única chamada ao Gemini
+        self.batch_max_size = 16
+        self.batch_window = 0.02  # 20ms
+        self._batch_queue: Optional[asyncio.Queue] = None
+        self._batcher_task: Optional[asyncio.Task] = None
+
+        # Sessão HTTP compartilhada: keep-alive + DNS cacheado evitam pagar
+        # handshake TCP/TLS em cada chamada à API (lazy, criada no 1º uso)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        # Cache exato de respostas: payloads idênticos (reenvios, retries de
+        # cliente, testes) retornam direto sem pagar o round-trip da API
+        self._response_cache: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._response_cache_max = 1024
+        self._response_cache_ttl = 3600  # 1h
+        self._response_cache_lock = asyncio.Lock()
+
+        # Cache semântico: emails parafraseados reaproveitam classificações
+        # anteriores (no-op se sentence-transformers não estiver instalado)
+        self._semantic_cache = SemanticCache()
+
+        # Esqueleto de payload das chamadas com tool calling: só o campo
+        # "contents" muda por request; tools/tool_config são montados uma vez
+        # por ferramenta e reutilizados
+        self._tool_gen_config = {
+            "temperature": 0.1,
+            "maxOutputTokens": 256,
+            "candidateCount": 1
+        }
+        self._tool_payload_cache: Dict[str, tuple] = {}
+
+        # Prefixo de classificação registrado no cachedContents da API: o
+        # servidor pula o prefill desses tokens; em falha seguimos com o
+        # prompt completo normalmente
+        self._cached_content_name: Optional[str] = None
+        self._cached_content_task: Optional[asyncio.Task] = None
+
+        # Em 3.12+ tasks curtas podem completar sem passar pelo scheduler;
+        # configurado no primeiro uso (precisa de um loop rodando)
+        self._loop_configured = False
+
+    def _configure_loop(self):
+        """Ativa eager tasks (Python 3.12+) no loop da aplicação, uma única vez"""
+        if self._loop_configured:
+            return
+        self._loop_configured = True
+        if sys.version_info >= (3, 12):
+            asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+            logger.info("Eager task factory enabled (Python 3.12+)")
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Retorna a ClientSession compartilhada, criando-a sob demanda"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=15),
+                connector=aiohttp.TCPConnector(
+                    limit=100,
+                    limit_per_host=32,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=60,
+                    enable_cleanup_closed=True
+                )
+            )
+        return self._session
+
+    async def close(self):
+        """Fecha a sessão HTTP compartilhada (chamado no shutdown da app)"""
+        if self._cached_content_task is not None and not self._cached_content_task.done():
+            self._cached_content_task.cancel()
+        if self._cached_content_name:
+            # Não deixa o último prefixo registrado (e cobrado) órfão no servidor
+            await self._delete_cached_content(self._cached_content_name)
+            self._cached_content_name = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def _ensure_cached_content(self) -> Optional[str]:
+        """
+        Garante que o refresher do prefixo está rodando e devolve o nome do
+        cachedContent atual (None enquanto não registrado - usa prompt cheio)
+        """
+        if self._cached_content_task is None or self._cached_content_task.done():
+            self._cached_content_task = asyncio.create_task(self._cached_content_loop())
+        return self._cached_content_name
+
+    async def _cached_content_loop(self):
+        """
+        Registra o prefixo estático de classificação (regras + tool) no
+        endpoint cachedContents e renova antes do TTL expirar. Qualquer
+        falha zera o nome e o fluxo volta ao prompt completo.
+        """
+        url = self.base_url.rsplit('/models', 1)[0] + '/cachedContents'
+        # Com cachedContent a request não pode redeclarar tools/tool_config,
+        # então eles entram junto com o prefixo aqui
+        payload = {
+            "model": f"models/{self.model}",
+            "contents": [{
+                "role": "user",
+                "parts": [{"text": _CLASSIFY_PROMPT_PREFIX}]
+            }],
+            "tools": [{
+                "function_declarations": [{
+                    "name": "classify_email",
+                    "description": "Classifica email como produtivo ou improdutivo",
+                    "parameters": _CLASSIFY_PARAMETERS
+                }]
+            }],
+            "toolConfig": {
+                "function_calling_config": {
+                    "mode": "ANY",
+                    "allowed_function_names": ["classify_email"]
+                }
+            },
+            "ttl": f"{self._CACHED_CONTENT_TTL}s"
+        }
+        while True:
+            stale_name = None
+            try:
+                session = await self._get_session()
+                async with session.post(url, data=orjson.dumps(payload), headers=self._base_headers,
+                                        timeout=aiohttp.ClientTimeout(total=15)) as response:
+                    if response.status == 200:
+                        result = orjson.loads(await response.read())
+                        stale_name = self._cached_content_name
+                        self._cached_content_name = result.get('name')
+                        logger.info("Classification prefix cached as %s", self._cached_content_name)
+                    else:
+                        self._cached_content_name = None
+                        logger.warning("cachedContents registration failed with status %s", response.status)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._cached_content_name = None
+                logger.warning("cachedContents registration error: %s", e)
+
+            # A entrada anterior continua viva (e cobrada) no servidor até o
+            # TTL: remove assim que a renovação registra a substituta
+            if stale_name and stale_name != self._cached_content_name:
+                await self._delete_cached_content(stale_name)
+
+            # Renova 5min antes de expirar; em falha tenta de novo em 10min
+            await asyncio.sleep(
+                self._CACHED_CONTENT_TTL - 300 if self._cached_content_name else 600
+            )
+
+    async def _delete_cached_content(self, name: str):
+        """DELETE best-effort de um cachedContent registrado no servidor"""
+        url = self.base_url.rsplit('/models', 1)[0] + '/' + name
+        try:
+            session = await self._get_session()
+            async with session.delete(url, headers=self._base_headers,
+                                      timeout=aiohttp.ClientTimeout(total=10)) as response:
+                if response.status != 200:
+                    logger.warning("cachedContents delete failed with status %s", response.status)
+        except Exception as e:
+            logger.warning("cachedContents delete error: %s", e)
+
+    @staticmethod
+    def _response_cache_key(model: str, prompt: str, tool_name: Optional[str], max_tokens: Optional[int]) -> bytes:
+        """Chave compacta: digest cobre modelo + prompt + parâmetros da chamada"""
+        raw = f"{model}|{tool_name}|{max_tokens}|{prompt}"
+        return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).digest()
+
+    async def _response_cache_get(self, key: bytes):
+        """Hit só vale dentro do TTL; entradas expiradas são removidas no acesso"""
+        async with self._response_cache_lock:
+            entry = self._response_cache.get(key)
+            if entry is None:
+                return None
+            ts, value = entry
+            if time.time() - ts >= self._response_cache_ttl:
+                del self._response_cache[key]
+                return None
+            self._response_cache.move_to_end(key)
+            return value
+
+    async def _response_cache_put(self, key: bytes, value):
+        async with self._response_cache_lock:
+            self._response_cache[key] = (time.time(), value)
+            self._response_cache.move_to_end(key)
+            if len(self._response_cache) > self._response_cache_max:
+                self._response_cache.popitem(last=False)
+
     async def classify_email_with_context(
-        self, 
-        content: str, 
+        self,
+        content: str,
         subject: Optional[str] = None,
         company_config: Optional[Dict[str, str]] = None
     ) -> Dict[str, Any]:
         """
         Classify email as productive or unproductive using tool calling for structured output
         Returns: Dict with 'category' (productive/unproductive) and reasoning
+
+        Requisições simultâneas são coalescidas pelo batcher numa só chamada à API.
+        """
+        self._configure_loop()
+        if self._batch_queue is None:
+            self._batch_queue = asyncio.Queue()
+        if self._batcher_task is None or self._batcher_task.done():
+            self._batcher_task = asyncio.create_task(self._classify_batcher())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._batch_queue.put((content, subject, company_config, future))
+        return await future
+
+    async def _classify_batcher(self):
         """
+        Drena a fila de classificações: espera até batch_max_size itens ou o
+        fim da janela (o que vier primeiro) e despacha cada grupo numa chamada
+        """
+        while True:
+            batch = [await self._batch_queue.get()]
+            deadline = asyncio.get_running_loop().time() + self.batch_window
+            while len(batch) < self.batch_max_size:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._batch_queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # Separa por configuração de empresa para preservar custom_instructions
+            groups: Dict[Any, list] = {}
+            for item in batch:
+                company_config = item[2]
+                key = (
+                    (company_config or {}).get('company_name'),
+                    (company_config or {}).get('custom_instructions')
+                )
+                groups.setdefault(key, []).append(item)
+
+            # Um único task despacha todos os grupos concorrentemente via
+            # gather (em vez de um wakeup do scheduler por grupo)
+            if len(groups) == 1:
+                asyncio.create_task(self._dispatch_classify_group(next(iter(groups.values()))))
+            else:
+                asyncio.create_task(self._dispatch_classify_groups(list(groups.values())))
+
+    async def _dispatch_classify_groups(self, groups):
+        """Despacha vários grupos de uma vez sobre a sessão compartilhada"""
+        await asyncio.gather(*(self._dispatch_classify_group(g) for g in groups))
+
+    async def _dispatch_classify_group(self, group):
+        """Resolve as futures de um grupo via chamada única (ou individual se n=1)"""
+        if len(group) == 1:
+            content, subject, company_config, future = group[0]
+            try:
+                result = await self._classify_single(content, subject, company_config)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
         try:
-            logger.info(f"[AI CLASSIFICATION] Starting with content length: {len(content)}, subject: '{subject}'")
-            if company_config:
-                logger.info(f"[AI CLASSIFICATION] Using custom config for: {company_config.get('company_name')}")
-            
-            if self._is_circuit_open():
-                logger.warning("[AI CLASSIFICATION] Circuit breaker is OPEN - skipping AI call")
-                raise Exception("Circuit breaker is open - too many recent errors")
-            
+            results = await self._classify_batch(group)
+            for (_, _, _, future), result in zip(group, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, _, _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _classify_batch(self, group) -> list:
+        """Classifica um lote de emails numa única chamada com tool calling"""
+        if self._is_circuit_open():
+            logger.warning("[AI CLASSIFICATION] Circuit breaker is OPEN - skipping batched AI call")
+            raise Exception("Circuit breaker is open - too many recent errors")
+
+        logger.info("[AI CLASSIFICATION] Coalescing %d emails into one Gemini call", len(group))
 
+        sections = []
+        for i, (content, subject, _config, _future) in enumerate(group, start=1):
+            content = _clean_email_text(content)
             limited_content = content[:3000] if len(content) > 3000 else content
-            subject_text = f"Assunto: {subject}\n\n" if subject else ""
-            
+            sections.append(f"EMAIL {i}:\nAssunto: {subject if subject else 'Sem assunto'}\nConteúdo: {limited_content}")
 
-            prompt = f"""Classifique este email como PRODUTIVO ou IMPRODUTIVO.
+        prompt = _CLASSIFY_BATCH_PROMPT_TEMPLATE.substitute(
+            count=len(group),
+            sections='\n'.join(sections)
+        )
 
-PRODUTIVO = Email relacionado aos NEGÓCIOS da empresa:
-• Dúvidas sobre produtos/serviços
-• Problemas técnicos ou bugs
-• Solicitações de suporte ou informações
-• Reclamações sobre serviços
-• Questões comerciais (preços, contratos)
-• Perguntas sobre a empresa (localização, horários, etc)
+        response = await self._call_with_tool_calling(
+            prompt=prompt,
+            tool_name="classify_emails",
+            tool_description="Classifica um lote de emails como produtivos ou improdutivos",
+            parameters={
+                "type": "object",
+                "properties": {
+                    "classifications": {
+                        "type": "array",
+                        "description": "Uma classificação por email, na mesma ordem",
+                        "items": _CLASSIFY_PARAMETERS
+                    }
+                },
+                "required": ["classifications"]
+            }
+        )
 
-IMPRODUTIVO = Email pessoal/social SEM relação com negócios:
-• Agradecimentos, gratificações, felicitações, convites são considerados pessoais/sociais
-• Perguntas pessoais sobre funcionários
-• Saudações sociais puras sem contexto
-• Spam ou marketing externo
-• Conversas casuais
-• Promoções, atualizações de serviços que não tem haver com uma empresa de tecnologia
+        classifications = response.get('classifications', [])
+        if len(classifications) != len(group):
+            raise Exception(
+                f"Batch classification returned {len(classifications)} results for {len(group)} emails"
+            )
+        return classifications
 
-REGRAS: Se o email pergunta ALGO SOBRE A EMPRESA OU SEUS SERVIÇOS → PRODUTIVO / SE O EMAIL FOR URGENTE SOBRE ALGO DA EMPRESA -> PRODUTIVO
+    async def _classify_single(
+        self,
+        content: str,
+        subject: Optional[str] = None,
+        company_config: Optional[Dict[str, str]] = None
+    ) -> Dict[str, Any]:
+        """Classifica um único email (caminho usado quando não há lote para coalescer)"""
+        try:
+            logger.info("[AI CLASSIFICATION] Starting with content length: %d, subject: %r", len(content), subject)
+            if company_config:
+                logger.info("[AI CLASSIFICATION] Using custom config for: %s", company_config.get('company_name'))
+            
+            if self._is_circuit_open():
+                logger.warning("[AI CLASSIFICATION] Circuit breaker is OPEN - skipping AI call")
+                raise Exception("Circuit breaker is open - too many recent errors")
 
+            # Tier semântico: email com mesmo significado já classificado?
+            semantic_emb = None
+            if self._semantic_cache.available:
+                semantic_text = f"{subject or ''}\n{content[:512]}"
+                cached, semantic_emb = await asyncio.to_thread(self._semantic_cache.lookup, semantic_text)
+                if cached is not None:
+                    logger.info("[AI CLASSIFICATION] Semantic cache hit - skipping Gemini call")
+                    return cached
 
-EMAIL:
-Assunto: {subject if subject else "Sem assunto"}
-Conteúdo: {limited_content}
+            content = _clean_email_text(content)
+            limited_content = content[:3000] if len(content) > 3000 else content
 
-Identifique o tipo de questão (ex: "problema técnico", "dúvida comercial", "conversa pessoal") e explique POR QUE é produtivo ou improdutivo em 2-3 frases claras."""
+            # Com o prefixo registrado no servidor, só o rabo variável viaja
+            cached_content = self._ensure_cached_content()
+            template = _CLASSIFY_PROMPT_TAIL_TEMPLATE if cached_content else _CLASSIFY_PROMPT_TEMPLATE
+            prompt = template.substitute(
+                subject=subject if subject else "Sem assunto",
+                content=limited_content
+            )
 
 
             response = await self._call_with_tool_calling(
                 prompt=prompt,
                 tool_name="classify_email",
                 tool_description="Classifica email como produtivo ou improdutivo",
-                parameters={
-                    "type": "object",
-                    "properties": {
-                        "category": {
-                            "type": "string",
-                            "enum": ["productive", "unproductive"],
-                            "description": "Categoria do email"
-                        },
-                        "issue_type": {
-                            "type": "string",
-                            "description": "Tipo de questão identificada (ex: 'problema técnico', 'dúvida comercial', 'conversa pessoal', 'spam')"
-                        },
-                        "reasoning": {
-                            "type": "string",
-                            "description": "Explicação específica (mínimo 30 palavras) do POR QUÊ é produtivo ou improdutivo. Deve identificar claramente o que torna este email relacionado ou não aos negócios da empresa."
-                        },
-                        "confidence": {
-                            "type": "string",
-                            "enum": ["high", "medium", "low"],
-                            "description": "Confiança na classificação"
-                        }
-                    },
-                    "required": ["category", "issue_type", "reasoning", "confidence"]
-                }
+                parameters=_CLASSIFY_PARAMETERS,
+                cached_content=cached_content
             )
             
-            logger.info(f"[AI CLASSIFICATION] Result: {response['category']} (confidence: {response.get('confidence', 'unknown')}) - {response['reasoning']}")
+            logger.info("[AI CLASSIFICATION] Result: %s (confidence: %s) - %s",
+                        response['category'], response.get('confidence', 'unknown'), response['reasoning'])
+            if semantic_emb is not None:
+                await asyncio.to_thread(self._semantic_cache.store, semantic_emb, response)
             return response
             
         except Exception as e:
-            logger.error(f"[AI CLASSIFICATION] Error: {str(e)}")
+            logger.error("[AI CLASSIFICATION] Error: %s", e)
             raise
     
     async def generate_response(self, context: str, category: str, subject: str = None, sender: str = None, company_config: Optional[Dict[str, str]] = None) -> Dict[str, str]:
@@ -122,11 +672,20 @@ Identifique o tipo de questão (ex: "problema técnico", "dúvida comercial", "c
         Gera uma resposta estruturada (destinatário, assunto, corpo) baseada no contexto
         """
         try:
+            self._configure_loop()
+
+            # Emails sociais triviais têm resposta pronta local, sem API
+            if category == 'unproductive':
+                canned = self._canned_unproductive_response(context, subject, sender, company_config)
+                if canned is not None:
+                    logger.info("[RESPONSE] Canned unproductive reply matched - skipping Gemini call")
+                    return canned
 
             if self._is_circuit_open():
                 raise Exception("Circuit breaker open - too many recent failures")
             
 
+            context = _clean_email_text(context)
             limited_context = context[:800] if len(context) > 800 else context
             prompt = self._create_structured_prompt(limited_context, category, subject, sender, company_config)
             
@@ -141,82 +700,141 @@ Identifique o tipo de questão (ex: "problema técnico", "dúvida comercial", "c
             return parsed
             
         except Exception as e:
-            logger.error(f"Error in AI text generation: {e}")
+            logger.error("Error in AI text generation: %s", e)
             raise Exception(f"Gemini Text Generation API failed: {e}")
-    
+
+    def _canned_unproductive_response(self, context: str, subject: str = None, sender: str = None, company_config: Optional[Dict[str, str]] = None) -> Optional[Dict[str, str]]:
+        """
+        Resposta pronta para emails improdutivos triviais (agradecimento,
+        convite, felicitação). Retorna None quando nenhuma variante casa e o
+        fluxo deve seguir para o Gemini.
+        """
+        lowered = context.lower()
+        variant = None
+        for name, keywords in _UNPRODUCTIVE_KEYWORDS.items():
+            if any(kw in lowered for kw in keywords):
+                variant = name
+                break
+        if variant is None:
+            return None
+
+        sender_email = None
+        sender_name = sender
+        if sender and '@' in sender:
+            sender_email = sender
+            sender_name = sender.split('@')[0].replace('.', ' ').title()
+        if not sender_email:
+            email_match = _EMAIL_RE.search(context)
+            if email_match:
+                sender_email = email_match.group(1)
+        if not sender_name:
+            sig_match = _SIG_RE.search(context)
+            if sig_match:
+                sender_name = sig_match.group(1).strip()
+
+        greeting = f"Prezado(a) {sender_name}" if sender_name and sender_name != sender_email else "Prezado(a)"
+        company_name = (company_config or {}).get('company_name', 'Equipe de Suporte')
+
+        # random.choice varia o texto entre reenvios, como pedimos ao modelo
+        body = random.choice(_UNPRODUCTIVE_TEMPLATES[variant]).format(
+            greeting=greeting,
+            company_name=company_name
+        )
+        return {
+            "to": sender_email if sender_email else "cliente@email.com",
+            "subject": f"Re: {subject}" if subject else "Re: Sua Solicitação",
+            "body": body
+        }
+
     def _is_circuit_open(self) -> bool:
         """Check if circuit breaker is open"""
-        current_time = time.time()
-        
+        # Caminho comum (circuito nunca abriu): uma comparação e pronto
+        if self.circuit_open_until == 0 and not self.circuit_breaker_errors:
+            return False
 
-        if current_time > self.circuit_open_until:
-            self.circuit_breaker_errors = []
+        now = time.monotonic()
+
+
+        if now > self.circuit_open_until:
+            self.circuit_breaker_errors.clear()
+            self.circuit_open_until = 0
             return False
-        
 
-        recent_errors = [t for t in self.circuit_breaker_errors if current_time - t < 60]
-        self.circuit_breaker_errors = recent_errors
-        
-        if len(recent_errors) >= self.circuit_breaker_threshold:
-            logger.warning(f"Circuit breaker open: {len(recent_errors)} errors in last minute")
+        # Expira erros com mais de 60s pela frente do deque, em O(1) cada
+        while self.circuit_breaker_errors and now - self.circuit_breaker_errors[0] >= 60:
+            self.circuit_breaker_errors.popleft()
+
+        if len(self.circuit_breaker_errors) >= self.circuit_breaker_threshold:
+            logger.warning("Circuit breaker open: %d errors in last minute", len(self.circuit_breaker_errors))
             return True
-        
+
         return False
-    
+
     def _record_error(self):
         """Record an error for circuit breaker"""
-        current_time = time.time()
-        self.circuit_breaker_errors.append(current_time)
-        
+        now = time.monotonic()
+        self.circuit_breaker_errors.append(now)
+
 
         if len(self.circuit_breaker_errors) >= self.circuit_breaker_threshold:
-            self.circuit_open_until = current_time + self.circuit_breaker_timeout
-            logger.warning(f"Circuit breaker opened for {self.circuit_breaker_timeout}s")
+            self.circuit_open_until = now + self.circuit_breaker_timeout
+            logger.warning("Circuit breaker opened for %ds", self.circuit_breaker_timeout)
     
     async def _call_with_retry(self, prompt: str, max_output_tokens: int = 512, max_attempts: int = 3) -> str:
         """Call Gemini API with retry logic and exponential backoff"""
-        for attempt in range(max_attempts):
+        # Caminho feliz: a primeira tentativa vai direto para a API, sem
+        # sleep nem checagem de backoff no meio do caminho
+        attempt = 0
+        while True:
+            last_attempt = attempt == max_attempts - 1
             try:
-
-                model = self.fallback_model if attempt > 0 else self.model
-                
- 
-                if attempt > 0:
-                    backoff = (2 ** attempt) + (asyncio.get_event_loop().time() % 1)
-                    logger.info(f"Retry attempt {attempt + 1}/{max_attempts} after {backoff:.2f}s with model {model}")
+                if attempt:
+                    model = self.fallback_model
+                    backoff = (1 << attempt) + random.random()
+                    logger.info("Retry attempt %d/%d after %.2fs with model %s", attempt + 1, max_attempts, backoff, model)
                     await asyncio.sleep(backoff)
-                
+                else:
+                    model = self.model
+
                 response = await self._call_gemini_api(prompt, max_output_tokens, model)
-                
+
                 if response:
-                    logger.info(f"Successful response on attempt {attempt + 1} with model {model}")
+                    logger.info("Successful response on attempt %d with model %s", attempt + 1, model)
                     return response
-                    
+
             except Exception as e:
                 error_str = str(e)
-                
 
                 if "503" in error_str or "UNAVAILABLE" in error_str:
                     self._record_error()
-                    logger.warning(f"503 error on attempt {attempt + 1}: {error_str}")
-                    
-
-                    if attempt < max_attempts - 1:
-                        continue
-                
+                    logger.warning("503 error on attempt %d: %s", attempt + 1, error_str)
 
-                if attempt == max_attempts - 1:
+                if last_attempt:
                     raise
-                    
-        raise Exception("All retry attempts failed")
+
+            if last_attempt:
+                raise Exception("All retry attempts failed")
+            attempt += 1
     
     async def _call_gemini_api(self, prompt: str, max_tokens: int = None, model: str = None) -> str:
         """
         Faz chamada para API do Gemini
         """
         current_model = model or self.model
-        url = f"{self.base_url}/{current_model}:generateContent"
-        
+        if current_model == self.model:
+            url = self._generate_url
+        elif current_model == self.fallback_model:
+            url = self._fallback_generate_url
+        else:
+            url = f"{self.base_url}/{current_model}:generateContent"
+
+        # Short-circuit: prompt idêntico já respondido dentro do TTL
+        cache_key = self._response_cache_key(current_model, prompt, None, max_tokens)
+        cached = await self._response_cache_get(cache_key)
+        if cached is not None:
+            logger.info("Gemini API exact-match cache hit, skipping HTTP call")
+            return cached
+
         payload = {
             "contents": [{
                 "role": "user",
@@ -232,103 +850,96 @@ Identifique o tipo de questão (ex: "problema técnico", "dúvida comercial", "c
             }
         }
         
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
         try:
-            logger.info(f"Starting Gemini API call with prompt length: {len(prompt)}")
-            
-            timeout = aiohttp.ClientTimeout(total=12) 
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(f"{url}?key={self.api_key}", json=payload, headers=headers) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        logger.info(f"Gemini API call successful")
-                        
+            logger.info("Starting Gemini API call with prompt length: %d", len(prompt))
+
+            session = await self._get_session()
+            async with session.post(url, data=orjson.dumps(payload), headers=self._base_headers,
+                                    timeout=aiohttp.ClientTimeout(total=12)) as response:
+                if response.status == 200:
+                    result = orjson.loads(await response.read())
+                    logger.info("Gemini API call successful")
+                    
 
-                        try:
-                            if 'candidates' in result and result['candidates']:
-                                candidate = result['candidates'][0]
-                                finish_reason = candidate.get('finishReason', 'UNKNOWN')
-                                logger.info(f"Gemini finish reason: {finish_reason}")
-                                
+                    try:
+                        if 'candidates' in result and result['candidates']:
+                            candidate = result['candidates'][0]
+                            finish_reason = candidate.get('finishReason', 'UNKNOWN')
+                            logger.info("Gemini finish reason: %s", finish_reason)
+                            
 
-                                generated_text = ""
+                            generated_text = ""
 
-                                if 'content' in candidate and 'parts' in candidate['content']:
+                            if 'content' in candidate and 'parts' in candidate['content']:
                  
-                                    parts = candidate['content']['parts']
-                                    generated_text = ''.join(part.get('text', '') for part in parts if 'text' in part)
-                                elif 'content' in candidate and 'text' in candidate['content']:
-                                    generated_text = candidate['content']['text']
-                                elif 'text' in candidate:
-                                    generated_text = candidate['text']
-                                
-                                if generated_text.strip():
-                                    logger.info(f"Extracted text ({len(generated_text)} chars): {generated_text[:100]}...")
-                                    return generated_text.strip()
-                                
-                              
-                                if finish_reason == 'MAX_TOKENS':
-                                    logger.warning("Response truncated due to max tokens, will retry with shorter prompt")
-                                    return ""
-                                
-                            logger.error(f"Could not extract text from response structure: {result}")
-                            return ""
+                                parts = candidate['content']['parts']
+                                generated_text = ''.join([part['text'] for part in parts if 'text' in part])
+                            elif 'content' in candidate and 'text' in candidate['content']:
+                                generated_text = candidate['content']['text']
+                            elif 'text' in candidate:
+                                generated_text = candidate['text']
                             
-                        except (KeyError, IndexError) as e:
-                            logger.error(f"Error parsing Gemini response: {e}")
-                            logger.error(f"Full response: {result}")
-                            return ""
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Gemini API call failed: {response.status} - {error_text}")
-                        raise Exception(f"Gemini API failed with status {response.status}")
+                            if generated_text.strip():
+                                if logger.isEnabledFor(logging.INFO):
+                                    logger.info("Extracted text (%d chars): %s...", len(generated_text), generated_text[:100])
+                                await self._response_cache_put(cache_key, generated_text.strip())
+                                return generated_text.strip()
+                            
+                          
+                            if finish_reason == 'MAX_TOKENS':
+                                logger.warning("Response truncated due to max tokens, will retry with shorter prompt")
+                                return ""
+                            
+                        logger.error("Could not extract text from response structure: %s", result)
+                        return ""
                         
+                    except (KeyError, IndexError) as e:
+                        logger.error("Error parsing Gemini response: %s", e)
+                        logger.error("Full response: %s", result)
+                        return ""
+                else:
+                    error_text = await response.text()
+                    logger.error("Gemini API call failed: %s - %s", response.status, error_text)
+                    raise Exception(f"Gemini API failed with status {response.status}")
+                    
         except asyncio.TimeoutError:
             logger.error("Gemini API call timed out")
             raise Exception("Gemini API timed out")
         except Exception as e:
-            logger.error(f"Error calling Gemini API: {str(e)}")
+            logger.error("Error calling Gemini API: %s", e)
             raise Exception(f"Gemini API call failed: {str(e)}")
     
     def _create_structured_prompt(self, context: str, category: str, subject: str = None, sender: str = None, company_config: Optional[Dict[str, str]] = None) -> str:
         """
         Cria prompt estruturado para gerar resposta em JSON com extração inteligente de informações
         """
-        import re
-        
-    
         sender_email = None
         sender_name = sender
-        
+
         if sender and '@' in sender:
             sender_email = sender
             sender_name = sender.split('@')[0].replace('.', ' ').title()
-        
-      
+
+
         if not sender_email:
-            email_match = re.search(r'([a-zA-Z0-9._-]+@[a-zA-Z0-9._-]+\.[a-zA-Z0-9_-]+)', context)
+            email_match = _EMAIL_RE.search(context)
             if email_match:
                 sender_email = email_match.group(1)
-        
-        
+
+
         if not sender_name or sender_name == sender:
-            sig_match = re.search(r'(?:Atenciosamente|Cordialmente|Abraços|At\.te)[,\s]*\n+([A-ZÁÉÍÓÚÂÊÔÃÕÇ][a-záéíóúâêôãõç]+(?:\s+[A-ZÁÉÍÓÚÂÊÔÃÕÇ][a-záéíóúâêôãõç]+)+)', context, re.IGNORECASE)
+            sig_match = _SIG_RE.search(context)
             if sig_match:
                 sender_name = sig_match.group(1).strip()
-        
-     
+
+
         sender_role = None
         if sender_name:
-            
-            name_pattern = re.escape(sender_name)
-            role_match = re.search(rf'{name_pattern}\s*\n\s*([A-ZÁÉÍÓÚÂÊÔÃÕÇ][a-záéíóúâêôãõç\s]+(?:de|da|do)\s+[A-ZÁÉÍÓÚÂÊÔÃÕÇ][a-záéíóúâêôãõç]+|[A-ZÁÉÍÓÚÂÊÔÃÕÇ][a-záéíóúâêôãõç\s]+)', context)
+            role_match = _role_re_for(sender_name).search(context)
             if role_match:
                 potential_role = role_match.group(1).strip()
-                
-                if not re.search(r'[@\d\(\)]', potential_role) and len(potential_role) < 50:
+
+                if not _ROLE_NOISE_RE.search(potential_role) and len(potential_role) < 50:
                     sender_role = potential_role
         
        
@@ -350,87 +961,40 @@ Identifique o tipo de questão (ex: "problema técnico", "dúvida comercial", "c
         if company_config and company_config.get('custom_instructions'):
             custom_instructions = f"\n\nINSTRUÇÕES PERSONALIZADAS DA EMPRESA:\n{company_config['custom_instructions']}"
         
-        if category == 'unproductive':
-            prompt = f"""Você é um assistente profissional da empresa {company_name}.
-
-CATEGORIA: Email social/pessoal (IMPRODUTIVO)
-
-CONTEXTO DO EMAIL RECEBIDO:
-{context}
-
-REMETENTE: {sender_context}
-ASSUNTO: {subject or 'Não especificado'}
-
-INSTRUÇÕES PARA RESPOSTA:
-1. Leia o contexto do email e identifique o tipo de mensagem (agradecimento, convite, felicitação, etc)
-2. Crie uma resposta BREVE (2-4 linhas) e personalizada para o contexto específico
-3. Seja cordial mas profissional
-4. VARIE o texto - não use sempre a mesma resposta genérica
-5. SEMPRE termine com: "Atenciosamente,\\n{company_name}"{custom_instructions}
-
-EXEMPLO DE VARIAÇÃO:
-- Para agradecimento: agradeça de volta e deseje sucesso
-- Para convite: agradeça pelo convite e responda educadamente
-- Para felicitação: agradeça e retribua os votos
-- Para mensagem genérica: seja cordial mas objetivo
-
-Gere APENAS um JSON válido com uma resposta personalizada:
-{{
-  "to": "{recipient}",
-  "subject": "{response_subject}",
-  "body": "[GERE RESPOSTA CURTA PERSONALIZADA BASEADA NO CONTEXTO]"
-}}"""
-        else:
-            prompt = f"""Você é um assistente profissional da empresa {company_name}.
-
-CATEGORIA: Email de negócios (PRODUTIVO)
-
-CONTEXTO DO EMAIL RECEBIDO:
-{context}
-
-REMETENTE: {sender_context}
-ASSUNTO: {subject or 'Não especificado'}
-
-INSTRUÇÕES PARA RESPOSTA:
-1. Analise o tipo de solicitação (problema técnico, dúvida comercial, suporte, etc)
-2. Seja ESPECÍFICO - mencione detalhes do problema/questão do remetente
-3. Ofereça solução clara ou próximos passos
-4. Use tom profissional mas acessível
-5. VARIE a resposta baseada no contexto - não use template genérico
-6. SEMPRE termine com: "Atenciosamente,\\n{company_name}"{custom_instructions}
-
-EXEMPLOS DE VARIAÇÃO:
-- Problema técnico: reconheça o problema específico + ofereça solução ou investigação
-- Dúvida comercial: responda a pergunta específica + ofereça mais informações se necessário
-- Suporte geral: responda a questão + indique canal apropriado se necessário
-
-Gere APENAS um JSON válido com resposta personalizada e específica:
-{{
-  "to": "{recipient}",
-  "subject": "{response_subject}",
-  "body": "[GERE RESPOSTA DETALHADA E ESPECÍFICA BASEADA NO CONTEXTO]"
-}}"""
-        
-        return prompt
+        template = _UNPRODUCTIVE_PROMPT_TEMPLATE if category == 'unproductive' else _PRODUCTIVE_PROMPT_TEMPLATE
+        return template.substitute(
+            company_name=company_name,
+            context=context,
+            sender_context=sender_context,
+            subject=subject or 'Não especificado',
+            custom_instructions=custom_instructions,
+            recipient=recipient,
+            response_subject=response_subject
+        )
     
     def _parse_structured_response(self, response: str, sender: str = None, subject: str = None) -> Dict[str, str]:
         """
         Parse JSON response from Gemini
         """
+        # Sonda barata: sem '{' não há JSON - evita regex, orjson e a
+        # construção de exceção/traceback do caminho de erro
+        if '{' not in response:
+            logger.warning("No JSON object in response, creating fallback")
+            return {
+                "to": sender if sender else "cliente@email.com",
+                "subject": f"Re: {subject}" if subject else "Resposta ao seu contato",
+                "body": self._format_response(response)
+            }
+
         try:
-            
-            response = response.strip()
-            
-            
-            if response.startswith("```"):
-                response = response.split("```")[1]
-                if response.startswith("json"):
-                    response = response[4:]
-            
-            
-            parsed = json.loads(response.strip())
-            
-            
+            # Uma busca só cobre cerca ```json, JSON puro e prosa+JSON
+            match = _JSON_BLOCK.search(response)
+            if not match:
+                raise ValueError("No JSON object in response")
+
+            parsed = orjson.loads(match.group(0))
+
+
             if "to" in parsed and "subject" in parsed and "body" in parsed:
                 return {
                     "to": parsed["to"],
@@ -441,7 +1005,7 @@ Gere APENAS um JSON válido com resposta personalizada e específica:
             raise ValueError("Missing required fields in JSON")
             
         except Exception as e:
-            logger.warning(f"Failed to parse JSON response, creating fallback: {e}")
+            logger.warning("Failed to parse JSON response, creating fallback: %s", e)
             
             
             return {
@@ -463,84 +1027,125 @@ Gere APENAS um JSON válido com resposta personalizada e específica:
         
         return formatted
     
-    async def _call_with_tool_calling(self, prompt: str, tool_name: str, tool_description: str, parameters: Dict[str, Any]) -> Dict[str, Any]:
+    async def _call_with_tool_calling(self, prompt: str, tool_name: str, tool_description: str, parameters: Dict[str, Any], cached_content: Optional[str] = None) -> Dict[str, Any]:
         """
         Call Gemini API with tool calling (function calling) for structured output
         """
-        url = f"{self.base_url}/{self.model}:generateContent"
-        
-        payload = {
-            "contents": [{
-                "role": "user",
-                "parts": [{"text": prompt}]
-            }],
-            "tools": [{
-                "function_declarations": [{
-                    "name": tool_name,
-                    "description": tool_description,
-                    "parameters": parameters
-                }]
-            }],
-            "tool_config": {
-                "function_calling_config": {
-                    "mode": "ANY",
-                    "allowed_function_names": [tool_name]
-                }
-            },
-            "generationConfig": {
-                "temperature": 0.1,  
-                "maxOutputTokens": 256,
-                "candidateCount": 1
+        # Short-circuit: mesma chamada estruturada já respondida dentro do TTL
+        cache_key = self._response_cache_key(self.model, prompt, tool_name, None)
+        cached = await self._response_cache_get(cache_key)
+        if cached is not None:
+            logger.info("[TOOL CALLING] Exact-match cache hit for %s, skipping HTTP call", tool_name)
+            return dict(cached)
+
+        if cached_content:
+            # O cachedContent já carrega o prefixo + tools; a request leva
+            # só o rabo variável do prompt
+            payload = {
+                "contents": [{
+                    "role": "user",
+                    "parts": [{"text": prompt}]
+                }],
+                "cachedContent": cached_content,
+                "generationConfig": self._tool_gen_config
+            }
+        else:
+            cached_decl = self._tool_payload_cache.get(tool_name)
+            if cached_decl is None:
+                cached_decl = (
+                    [{
+                        "function_declarations": [{
+                            "name": tool_name,
+                            "description": tool_description,
+                            "parameters": parameters
+                        }]
+                    }],
+                    {
+                        "function_calling_config": {
+                            "mode": "ANY",
+                            "allowed_function_names": [tool_name]
+                        }
+                    }
+                )
+                self._tool_payload_cache[tool_name] = cached_decl
+            tools, tool_config = cached_decl
+
+            payload = {
+                "contents": [{
+                    "role": "user",
+                    "parts": [{"text": prompt}]
+                }],
+                "tools": tools,
+                "tool_config": tool_config,
+                "generationConfig": self._tool_gen_config
             }
-        }
-        
-        headers = {
-            "Content-Type": "application/json"
-        }
         
         try:
-            logger.info(f"[TOOL CALLING] Invoking {tool_name} with prompt length: {len(prompt)}")
-            
-            timeout = aiohttp.ClientTimeout(total=15)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(f"{url}?key={self.api_key}", json=payload, headers=headers) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        logger.info(f"[TOOL CALLING] API call successful")
-                        
-                       
-                        if 'candidates' in result and result['candidates']:
-                            candidate = result['candidates'][0]
-                            
-                            if 'content' in candidate and 'parts' in candidate['content']:
-                                for part in candidate['content']['parts']:
-                                    if 'functionCall' in part:
-                                        function_call = part['functionCall']
-                                        if function_call.get('name') == tool_name:
-                                            args = function_call.get('args', {})
-                                            logger.info(f"[TOOL CALLING] Extracted args: {args}")
-                                            return args
-                        
-                        
-                        logger.warning("[TOOL CALLING] No function call found, trying text fallback")
-                        if 'candidates' in result and result['candidates']:
-                            candidate = result['candidates'][0]
-                            if 'content' in candidate and 'parts' in candidate['content']:
-                                text = candidate['content']['parts'][0].get('text', '')
-                                try:
-                                    return json.loads(text.strip())
-                                except:
-                                    pass
-                        
-                        raise Exception("Could not extract structured output from response")
+            logger.info("[TOOL CALLING] Invoking %s with prompt length: %d", tool_name, len(prompt))
+
+            session = await self._get_session()
+            async with session.post(self._generate_url, data=orjson.dumps(payload), headers=self._base_headers,
+                                    timeout=aiohttp.ClientTimeout(total=15)) as response:
+                if response.status == 200:
+                    if ijson is not None:
+                        # Parse incremental: retorna assim que o functionCall
+                        # aparece no stream, sem bufferizar o corpo inteiro
+                        tee = _TeeStream(response.content)
+                        async for function_call in ijson.items(
+                            tee, 'candidates.item.content.parts.item.functionCall'
+                        ):
+                            if function_call.get('name') == tool_name:
+                                args = function_call.get('args', {})
+                                logger.info("[TOOL CALLING] Extracted args (streamed): %s", args)
+                                await self._response_cache_put(cache_key, dict(args))
+                                return args
+                        # Sem functionCall no stream: o corpo inteiro já
+                        # passou pelo tee, então o fallback de texto abaixo
+                        # roda sobre os mesmos bytes — igual ao caminho
+                        # bufferizado sem ijson
+                        result = orjson.loads(bytes(tee.buffer))
                     else:
-                        error_text = await response.text()
-                        logger.error(f"[TOOL CALLING] API call failed: {response.status} - {error_text}")
-                        raise Exception(f"Tool calling API failed with status {response.status}")
+                        result = orjson.loads(await response.read())
+                    logger.info("[TOOL CALLING] API call successful")
+                    
+                   
+                    if 'candidates' in result and result['candidates']:
+                        candidate = result['candidates'][0]
                         
+                        if 'content' in candidate and 'parts' in candidate['content']:
+                            for part in candidate['content']['parts']:
+                                if 'functionCall' in part:
+                                    function_call = part['functionCall']
+                                    if function_call.get('name') == tool_name:
+                                        args = function_call.get('args', {})
+                                        logger.info("[TOOL CALLING] Extracted args: %s", args)
+                                        await self._response_cache_put(cache_key, dict(args))
+                                        return args
+                    
+                    
+                    logger.warning("[TOOL CALLING] No function call found, trying text fallback")
+                    if 'candidates' in result and result['candidates']:
+                        candidate = result['candidates'][0]
+                        if 'content' in candidate and 'parts' in candidate['content']:
+                            text = candidate['content']['parts'][0].get('text', '')
+                            try:
+                                return orjson.loads(text.strip())
+                            except:
+                                pass
+                    
+                    raise Exception("Could not extract structured output from response")
+                else:
+                    error_text = await response.text()
+                    if cached_content:
+                        # Prefixo pode ter expirado no servidor: zera para as
+                        # próximas chamadas voltarem ao prompt completo
+                        self._cached_content_name = None
+                    logger.error("[TOOL CALLING] API call failed: %s - %s", response.status, error_text)
+                    raise Exception(f"Tool calling API failed with status {response.status}")
+                    
         except asyncio.TimeoutError:
             logger.error("[TOOL CALLING] API call timed out")
             raise Exception("Tool calling API timed out")
         except Exception as e:
-            logger.error(f"[TOOL CALLING] Error: {str(e)}")
+            logger.error("[TOOL CALLING] Error: %s", e)
             raise Exception(f"Tool calling failed: {str(e)}")
\ No newline at end of file
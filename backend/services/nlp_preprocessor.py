@@ -1,5 +1,8 @@
+import hashlib
 import re
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, Optional, List
 from unidecode import unidecode
 
@@ -49,7 +52,77 @@ class NLPPreprocessor:
             r'o mais rápido possível',
             r'quanto antes'
         ]
-        
+
+        # Padrões compilados uma única vez: chamar o método bound do pattern
+        # evita o lookup no cache interno do re a cada uso
+        self._re_ws = re.compile(r'[^\S\n]+')  # whitespace exceto newline
+        self._re_nl = re.compile(r'\n{3,}')
+        # URLs, emails e telefones num único regex com grupos nomeados:
+        # um finditer extrai as três estruturas numa passada só
+        self._structures_re = re.compile(
+            r'(?P<url>http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)'
+            r'|(?P<email>\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b)'
+            r'|(?P<phone>(?:\+?\d{2}[\s-]?)?\(?\d{2}\)?[\s-]?\d{4,5}[\s-]?\d{4})'  # BR: +55 (11) 99999-9999
+        )
+        # Palavras-chave técnicas e de negócio (todas de uma palavra só:
+        # a busca vira membership em frozenset sobre os tokens do texto)
+        self.business_keywords = [
+            'problema', 'erro', 'bug', 'falha', 'defeito',
+            'ajuda', 'suporte', 'dúvida', 'questão', 'pergunta',
+            'produto', 'serviço', 'compra', 'pagamento', 'preço',
+            'contrato', 'proposta', 'orçamento',
+            'reclamação', 'insatisfação', 'insatisfeito',
+            'urgente', 'imediato', 'prazo',
+            'funcionar', 'acessar', 'instalar', 'configurar',
+            'cancelar', 'devolver', 'reembolso'
+        ]
+        self.business_keywords_set = frozenset(self.business_keywords)
+        # Bit estável por keyword: presença/ausência do vocabulário inteiro
+        # cabe num único int em vez de uma lista de strings por email
+        self._kw_bit = {kw: 1 << i for i, kw in enumerate(self.business_keywords)}
+        self._re_word = re.compile(r'\w+')
+
+        # Radicais que capturam flexões que o match exato perde
+        # ('reclamei', 'problemático', 'cancelou'...), mapeados para o
+        # keyword canônico da bitmask. O lookup agrupa por comprimento:
+        # um fatiamento + dict.get por comprimento distinto de radical.
+        self._kw_stems = {
+            'problem': 'problema',
+            'falh': 'falha',
+            'reclam': 'reclamação',
+            'insatisf': 'insatisfeito',
+            'urgent': 'urgente',
+            'cancel': 'cancelar',
+            'devolv': 'devolver',
+            'reembols': 'reembolso',
+            'orçament': 'orçamento',
+        }
+        self._stem_lengths = sorted({len(stem) for stem in self._kw_stems})
+
+        # Alternação única por estágio: uma passada no texto remove/detecta
+        # tudo, em vez de uma varredura completa por padrão
+        self._auto_sig_combined = re.compile(
+            '|'.join(f'(?:{p})' for p in self.auto_signatures),
+            re.IGNORECASE | re.DOTALL
+        )
+        self._urgency_combined = re.compile(
+            '|'.join(f'(?:{p})' for p in self.urgency_patterns)
+        )
+        # Indicadores de português numa alternação só (antes: 8 varreduras)
+        self._pt_indicators_re = re.compile('ção|ões|ão|ê|á|à|ó|ô')
+
+        # Em textos longos a extração de estruturas (que lê o texto
+        # original) roda em paralelo com a cadeia de limpeza - o re solta
+        # o GIL durante matches longos
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        self._parallel_threshold = 8192
+
+        # Cache LRU do pipeline completo: reprocessamentos (retry,
+        # reclassificação) do mesmo email não pagam o pipeline de novo
+        self._pipeline_cache: OrderedDict = OrderedDict()
+        self._normalize_cache: OrderedDict = OrderedDict()
+        self._cache_max = 1024
+
     def preprocess(self, text: str, remove_stopwords: bool = False) -> Dict[str, Any]:
         """
         Pré-processa texto completo e retorna texto limpo + metadados
@@ -61,30 +134,48 @@ class NLPPreprocessor:
         Returns:
             Dict com texto limpo e metadados extraídos
         """
+        cache_key = (self._text_digest(text), remove_stopwords)
+        cached = self._pipeline_cache.get(cache_key)
+        if cached is not None:
+            self._pipeline_cache.move_to_end(cache_key)
+            return self._copy_result(cached)
+
         try:
             logger.info(f"[NLP] Starting preprocessing for text length: {len(text)}")
-            
+
+            # Estruturas dependem só do texto original: em textos longos a
+            # varredura roda em background enquanto a limpeza avança
+            structures_future = None
+            if len(text) > self._parallel_threshold:
+                structures_future = self._executor.submit(self._extract_structures, text)
+
             # 1. Normalização básica
             cleaned_text = self._normalize_text(text)
             
             # 2. Remover assinaturas automáticas
             cleaned_text = self._remove_auto_signatures(cleaned_text)
-            
-            # 3. Extrair estruturas importantes
-            urls = self._extract_urls(text)
-            emails = self._extract_emails(text)
-            phones = self._extract_phones(text)
+
+            # Lowercase uma única vez; os helpers recebem a versão pronta em
+            # vez de cada um alocar a sua própria cópia do texto
+            cleaned_lower = cleaned_text.lower()
+
+            # 3. Extrair estruturas importantes (passada única)
+            if structures_future is not None:
+                urls, emails, phones = structures_future.result()
+            else:
+                urls, emails, phones = self._extract_structures(text)
             
             # 4. Detectar idioma (básico)
-            language = self._detect_language(cleaned_text)
-            
+            language = self._detect_language(cleaned_lower)
+
             # 5. Remover stop words se solicitado (OPCIONAL)
             processed_text = cleaned_text
             if remove_stopwords:
-                processed_text = self._remove_stopwords(cleaned_text)
-            
+                processed_text = self._remove_stopwords(cleaned_lower)
+
             # 6. Extrair palavras-chave importantes
-            keywords = self._extract_keywords(cleaned_text)
+            keywords_mask = self._extract_keywords(cleaned_lower)
+            keywords = self.keywords_from_mask(keywords_mask)
             
             result = {
                 'original_text': text,
@@ -96,14 +187,20 @@ class NLPPreprocessor:
                     'phones': phones,
                     'language': language,
                     'keywords': keywords,
+                    'keywords_mask': keywords_mask,
                     'text_length': len(cleaned_text),
                     'word_count': len(cleaned_text.split()),
-                    'has_urgency': self._detect_urgency(cleaned_text)
+                    'has_urgency': self._detect_urgency(cleaned_text, cleaned_lower)
                 }
             }
             
             logger.info(f"[NLP] Preprocessing complete. Words: {result['metadata']['word_count']}, Keywords: {len(keywords)}")
-            return result
+
+            # Só resultados bem-sucedidos entram no cache
+            self._pipeline_cache[cache_key] = result
+            if len(self._pipeline_cache) > self._cache_max:
+                self._pipeline_cache.popitem(last=False)
+            return self._copy_result(result)
             
         except Exception as e:
             logger.error(f"[NLP] Error in preprocessing: {str(e)}")
@@ -117,116 +214,158 @@ class NLPPreprocessor:
                 }
             }
     
+    @staticmethod
+    def _text_digest(text: str) -> bytes:
+        """Hash estável e barato do texto para chave de cache"""
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    @staticmethod
+    def _copy_result(result: Dict[str, Any]) -> Dict[str, Any]:
+        """Cópia do resultado para o caller não mutar a entrada cacheada"""
+        copied = dict(result)
+        # As listas do metadata (urls, keywords...) também precisam de
+        # cópia própria, senão um append do caller contamina o cache
+        copied['metadata'] = {
+            key: list(value) if isinstance(value, list) else value
+            for key, value in result['metadata'].items()
+        }
+        return copied
+
     def _normalize_text(self, text: str) -> str:
         """Normaliza texto: remove espaços extras, normaliza quebras de linha"""
-        # Remove espaços múltiplos
-        text = re.sub(r'\s+', ' ', text)
+        # Remove espaços múltiplos preservando newlines — o \s+ antigo
+        # engolia as quebras e tornava o passo seguinte um no-op
+        text = self._re_ws.sub(' ', text)
         # Normaliza quebras de linha (max 2 consecutivas)
-        text = re.sub(r'\n{3,}', '\n\n', text)
+        text = self._re_nl.sub('\n\n', text)
         # Remove espaços no início e fim
         return text.strip()
-    
+
     def _remove_auto_signatures(self, text: str) -> str:
         """Remove assinaturas automáticas conhecidas"""
-        cleaned = text
-        for pattern in self.auto_signatures:
-            cleaned = re.sub(pattern, '', cleaned, flags=re.IGNORECASE | re.DOTALL)
-        return cleaned.strip()
-    
-    def _extract_urls(self, text: str) -> List[str]:
-        """Extrai URLs do texto"""
-        url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-        return re.findall(url_pattern, text)
-    
-    def _extract_emails(self, text: str) -> List[str]:
-        """Extrai endereços de email"""
-        email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-        return re.findall(email_pattern, text)
-    
-    def _extract_phones(self, text: str) -> List[str]:
-        """Extrai números de telefone (formato brasileiro e internacional)"""
-        phone_patterns = [
-            r'\+?\d{2}[\s-]?\(?\d{2}\)?[\s-]?\d{4,5}[\s-]?\d{4}',  # BR: +55 (11) 99999-9999
-            r'\(?\d{2}\)?[\s-]?\d{4,5}[\s-]?\d{4}'  # BR: (11) 99999-9999
-        ]
-        phones = []
-        for pattern in phone_patterns:
-            phones.extend(re.findall(pattern, text))
-        return phones
+        return self._auto_sig_combined.sub('', text).strip()
+
+    def _extract_structures(self, text: str):
+        """Extrai URLs, emails e telefones numa única varredura do texto"""
+        urls: List[str] = []
+        emails: List[str] = []
+        phones: List[str] = []
+        append_for = {'url': urls.append, 'email': emails.append, 'phone': phones.append}
+        for match in self._structures_re.finditer(text):
+            append_for[match.lastgroup](match.group())
+        return urls, emails, phones
     
-    def _detect_language(self, text: str) -> str:
+    def _detect_language(self, text_lower: str) -> str:
         """Detecção básica de idioma (português vs inglês)"""
-        portuguese_indicators = ['ção', 'ões', 'ão', 'ê', 'á', 'à', 'ó', 'ô']
-        text_lower = text.lower()
-        
-        pt_count = sum(1 for indicator in portuguese_indicators if indicator in text_lower)
-        
-        return 'pt' if pt_count > 2 else 'en'
-    
-    def _remove_stopwords(self, text: str) -> str:
+        # Uma passada com early exit: 3 indicadores bastam para decidir
+        pt_count = 0
+        for _ in self._pt_indicators_re.finditer(text_lower):
+            pt_count += 1
+            if pt_count > 2:
+                return 'pt'
+        return 'en'
+
+    def _remove_stopwords(self, text_lower: str) -> str:
         """
         Remove stop words mantendo palavras importantes
         CUIDADO: Pode remover contexto importante!
         """
-        words = text.lower().split()
-        filtered_words = [word for word in words if word not in self.stop_words]
-        return ' '.join(filtered_words)
-    
-    def _extract_keywords(self, text: str) -> List[str]:
+        # Generator + método bound: evita a lista intermediária e o lookup
+        # de atributo por palavra (o texto já chega lowercased do caller)
+        is_stopword = self.stop_words.__contains__
+        return ' '.join(word for word in text_lower.split() if not is_stopword(word))
+
+    def _extract_keywords(self, text_lower: str) -> int:
         """
-        Extrai palavras-chave relevantes (substantivos, verbos importantes)
+        Extrai palavras-chave relevantes como bitmask (1 bit por keyword)
         """
-        # Palavras-chave técnicas e de negócio
-        business_keywords = [
-            'problema', 'erro', 'bug', 'falha', 'defeito',
-            'ajuda', 'suporte', 'dúvida', 'questão', 'pergunta',
-            'produto', 'serviço', 'compra', 'pagamento', 'preço',
-            'contrato', 'proposta', 'orçamento',
-            'reclamação', 'insatisfação', 'insatisfeito',
-            'urgente', 'imediato', 'prazo',
-            'funcionar', 'acessar', 'instalar', 'configurar',
-            'cancelar', 'devolver', 'reembolso'
-        ]
-        
-        text_lower = text.lower()
-        found_keywords = [kw for kw in business_keywords if kw in text_lower]
-        
-        return found_keywords
-    
-    def _detect_urgency(self, text: str) -> bool:
+        # Tokeniza uma vez e intersecta com o frozenset: O(N) no texto em vez
+        # de uma varredura de substring por keyword
+        tokens = set(self._re_word.findall(text_lower))
+        mask = 0
+        for keyword in self.business_keywords_set.intersection(tokens):
+            mask |= self._kw_bit[keyword]
+
+        # Match por radical: 'reclamei' conta como 'reclamação' etc.
+        stems = self._kw_stems
+        for token in tokens:
+            for length in self._stem_lengths:
+                if len(token) >= length:
+                    keyword = stems.get(token[:length])
+                    if keyword is not None:
+                        mask |= self._kw_bit[keyword]
+                        break
+        return mask
+
+    def keywords_from_mask(self, mask: int) -> List[str]:
+        """Decodifica a bitmask de keywords para a lista legível (logs, UI)"""
+        return [kw for kw in self.business_keywords if mask & self._kw_bit[kw]]
+
+    def _detect_urgency(self, text: str, text_lower: str) -> bool:
         """Detecta se o texto contém indicadores de urgência"""
-        text_lower = text.lower()
-        
-        # Verificar padrões de urgência
-        for pattern in self.urgency_patterns:
-            if re.search(pattern, text_lower):
-                return True
-        
-        # Verificar excesso de exclamações (indicador de urgência/emoção)
-        exclamation_count = text.count('!')
-        if exclamation_count >= 3:
+        # Checks ordenados do mais barato para o mais caro, cada um com
+        # early return
+
+        # Excesso de exclamações (count roda em C, um passe simples)
+        if text.count('!') >= 3:
             return True
-        
-        # Verificar CAPS LOCK excessivo
-        if text.isupper() and len(text) > 20:
+
+        # Padrões de urgência (alternação única compilada)
+        if self._urgency_combined.search(text_lower):
             return True
-        
+
+        # CAPS LOCK excessivo (early-exit na primeira minúscula)
+        if len(text) > 20 and self._is_mostly_upper(text):
+            return True
+
         return False
+
+    @staticmethod
+    def _is_mostly_upper(text: str) -> bool:
+        """
+        Versão com early-exit do str.isupper(): um email normal tem
+        minúscula nos primeiros caracteres, então sai quase sempre no
+        começo em vez de varrer o texto inteiro. Olha só o prefixo -
+        se os primeiros 200 chars são todos maiúsculos, é gritaria.
+        """
+        has_upper = False
+        for c in text[:200]:
+            if c.islower():
+                return False
+            if c.isupper():
+                has_upper = True
+        return has_upper
     
     def normalize_for_ai(self, text: str) -> str:
         """
         Normaliza texto especificamente para envio à IA
         Remove apenas ruído sem perder contexto
         """
+        cache_key = self._text_digest(text)
+        cached = self._normalize_cache.get(cache_key)
+        if cached is not None:
+            self._normalize_cache.move_to_end(cache_key)
+            return cached
+
+        max_length = 3000
+
+        # Corta cedo com folga: só os primeiros ~12kB podem sobreviver ao
+        # corte final, então as passadas de regex não precisam varrer
+        # corpos arbitrariamente grandes
+        if len(text) > 4 * max_length:
+            text = text[:4 * max_length]
+
         # Remove assinaturas automáticas
         text = self._remove_auto_signatures(text)
-        
+
         # Normaliza espaços
         text = self._normalize_text(text)
-        
+
         # Limita tamanho (para evitar token overflow)
-        max_length = 3000
         if len(text) > max_length:
             text = text[:max_length] + "...[texto truncado]"
-        
+
+        self._normalize_cache[cache_key] = text
+        if len(self._normalize_cache) > self._cache_max:
+            self._normalize_cache.popitem(last=False)
         return text
@@ -0,0 +1,96 @@
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy está em requirements
+    np = None
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # sentence-transformers é opcional - sem ele o cache fica desativado
+    SentenceTransformer = None
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """
+    Cache semântico de classificações: emails com o mesmo significado
+    ("não consigo fazer login", "cancelar assinatura"...) reaproveitam o
+    resultado anterior via similaridade de cosseno dos embeddings, sem
+    precisar chamar o Gemini de novo.
+
+    Requer sentence-transformers instalado; sem ele, `available` é False e
+    todas as operações viram no-ops (o fluxo segue direto para a API).
+    """
+
+    # Modelo pequeno e multilíngue (384 dims, ~5ms de encode em CPU)
+    MODEL_NAME = "paraphrase-multilingual-MiniLM-L12-v2"
+
+    # Similaridade mínima para considerar dois emails equivalentes
+    SIMILARITY_THRESHOLD = 0.92
+
+    # Limite de entradas (eviction FIFO)
+    MAX_ENTRIES = 10_000
+
+    def __init__(self):
+        self._model = None  # carregado no primeiro uso (o load é caro)
+        # Matriz (N, 384) float32 L2-normalizada + lista paralela de resultados
+        self._matrix = None
+        self._values = []
+        # lookup/store rodam em threads (asyncio.to_thread): o lock mantém
+        # matriz e lista de valores sempre consistentes entre si
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return np is not None and SentenceTransformer is not None
+
+    def _encode(self, text: str):
+        if self._model is None:
+            logger.info(f"[SEMANTIC CACHE] Loading embedding model: {self.MODEL_NAME}")
+            self._model = SentenceTransformer(self.MODEL_NAME)
+        return self._model.encode(text, normalize_embeddings=True).astype(np.float32)
+
+    def lookup(self, text: str) -> Tuple[Optional[Dict[str, Any]], Optional[Any]]:
+        """
+        Retorna (resultado_cacheado_ou_None, embedding). O embedding é
+        devolvido para ser reaproveitado num `store` posterior em caso de miss.
+        """
+        if not self.available:
+            return None, None
+
+        emb = self._encode(text)
+        with self._lock:
+            if self._matrix is None or not self._values:
+                return None, emb
+
+            # gemv única: cosseno contra todo o cache (embeddings normalizados)
+            scores = self._matrix @ emb
+            best = int(np.argmax(scores))
+            similarity = float(scores[best])
+            if similarity <= self.SIMILARITY_THRESHOLD:
+                return None, emb
+            value = dict(self._values[best])
+
+        logger.info(f"[SEMANTIC CACHE] Hit (similarity={similarity:.3f})")
+        return value, emb
+
+    def store(self, emb, value: Dict[str, Any]):
+        """Acrescenta o embedding e o resultado ao cache (FIFO acima do limite)"""
+        if not self.available or emb is None:
+            return
+
+        row = emb.reshape(1, -1)
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = row
+            else:
+                self._matrix = np.vstack([self._matrix, row])
+            self._values.append(dict(value))
+
+            if len(self._values) > self.MAX_ENTRIES:
+                self._matrix = self._matrix[1:]
+                self._values.pop(0)
@@ -1,14 +1,34 @@
 import re
 import logging
+from collections import Counter
 from typing import Dict, Any, List
 
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick é opcional - sem ele usamos a alternação regex
+    ahocorasick = None
+
+try:
+    import numpy as np
+except ImportError:  # numpy é opcional - sem ele o Counter cobre textos grandes
+    np = None
+
+# Acima deste tamanho a contagem vetorizada do numpy ganha do Counter
+_NUMPY_SCAN_THRESHOLD = 2048
+
 logger = logging.getLogger(__name__)
 
 class TextFeatureExtractor:
     """
     Extrator de features numéricas e categóricas de texto para enriquecer classificação
     """
-    
+
+    # Memo compartilhado de classificação de chars: o conjunto de chars
+    # distintos entre emails é pequeno e estável, então cada char paga
+    # isalpha/isupper uma única vez no processo inteiro
+    _char_classes: Dict[str, tuple] = {}
+
+
     def __init__(self):
         # Palavras que indicam problemas técnicos
         self.technical_keywords = [
@@ -37,17 +57,160 @@ class TextFeatureExtractor:
             'convite', 'celebração', 'gratidão', 'obrigado por tudo',
             'abraço', 'beijo', 'feliz', 'alegria'
         ]
-    
-    def extract_all_features(self, text: str, subject: str = None) -> Dict[str, Any]:
+
+        # Palavras de urgência e de sentimento (entram na varredura única)
+        self.urgency_keywords = [
+            'urgente', 'imediato', 'asap', 'rápido', 'prazo',
+            'emergência', 'crítico', 'quanto antes'
+        ]
+        self.negative_words = [
+            'não', 'nunca', 'nada', 'ninguém', 'problema', 'erro',
+            'falha', 'ruim', 'péssimo', 'horrível', 'insatisfeito',
+            'reclamação', 'decepcionado', 'frustrado'
+        ]
+        self.positive_words = [
+            'obrigado', 'agradeço', 'excelente', 'ótimo', 'bom',
+            'parabéns', 'feliz', 'satisfeito', 'gostei', 'adorei'
+        ]
+
+        # Varredura única: todos os vocabulários entram num autômato
+        # Aho-Corasick (uma passada O(N) responde quais keywords ocorrem);
+        # sem pyahocorasick, a alternação regex equivalente faz o mesmo
+        # papel em uma passada só. Um keyword pode pertencer a mais de uma
+        # categoria (ex.: 'erro' é technical e negative).
+        self._keyword_categories: Dict[str, tuple] = {}
+        for category, keywords in (
+            ('technical', self.technical_keywords),
+            ('business', self.business_keywords),
+            ('support', self.support_keywords),
+            ('social', self.social_keywords),
+            ('urgency', self.urgency_keywords),
+            ('negative', self.negative_words),
+            ('positive', self.positive_words),
+        ):
+            for keyword in keywords:
+                self._keyword_categories[keyword] = self._keyword_categories.get(keyword, ()) + (category,)
+
+        if ahocorasick is not None:
+            self._keyword_automaton = ahocorasick.Automaton()
+            for keyword, categories in self._keyword_categories.items():
+                self._keyword_automaton.add_word(keyword, (keyword, categories))
+            self._keyword_automaton.make_automaton()
+            self._keyword_scan_re = None
+        else:
+            self._keyword_automaton = None
+            # Mais longos primeiro para que frases ganhem dos seus prefixos
+            self._keyword_scan_re = re.compile(
+                '|'.join(re.escape(kw) for kw in sorted(self._keyword_categories, key=len, reverse=True))
+            )
+
+        # Padrões de prazo/data limite
+        self.deadline_patterns = [
+            r'prazo',
+            r'até (hoje|amanhã|segunda|terça|quarta|quinta|sexta)',
+            r'até (?:dia|o dia) \d{1,2}',
+            r'deadline',
+            r'data limite'
+        ]
+
+        # Padrões compilados uma única vez: o método bound do pattern evita o
+        # lookup no cache interno do re a cada extração
+        self._re_url = re.compile(r'http[s]?://')
+        self._re_email = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+        self._re_phone = re.compile(r'\(?\d{2}\)?[\s-]?\d{4,5}[\s-]?\d{4}')
+        self._re_number = re.compile(r'\b\d+\b')
+        self._re_date = re.compile(r'\d{1,2}[/-]\d{1,2}[/-]\d{2,4}')
+        self._re_bullet = re.compile(r'^\s*[-•*]\s', re.MULTILINE)
+        self._re_sentence_split = re.compile(r'[.!?]+')
+        # Alternação única: um passe pelo texto cobre todos os padrões de prazo
+        self._deadline_combined = re.compile(
+            '|'.join(f'(?:{p})' for p in self.deadline_patterns),
+            re.IGNORECASE
+        )
+
+    @staticmethod
+    def _scan_chars(text: str):
+        """
+        Uma única passada no texto (Counter roda em C) cobre pontuação e
+        caps ratio; o loop em Python itera só sobre os chars distintos.
+        Textos grandes usam contagem vetorizada (SIMD) sobre os bytes UTF-8
+        - '?' e '!' são exatos; o caps ratio considera só letras ASCII, o
+        que é uma aproximação aceitável em corpos longos.
+        """
+        if np is not None and len(text) > _NUMPY_SCAN_THRESHOLD:
+            buf = np.frombuffer(text.encode('utf-8', 'ignore'), dtype=np.uint8)
+            question_count = int(np.count_nonzero(buf == 0x3F))
+            exclamation_count = int(np.count_nonzero(buf == 0x21))
+            upper = int(np.count_nonzero((buf >= 0x41) & (buf <= 0x5A)))
+            lower = int(np.count_nonzero((buf >= 0x61) & (buf <= 0x7A)))
+            letters = upper + lower
+            caps_ratio = upper / letters if letters else 0.0
+            return question_count, exclamation_count, caps_ratio
+
+        counts = Counter(text)
+        letters = 0
+        caps = 0
+        char_classes = TextFeatureExtractor._char_classes
+        for ch, n in counts.items():
+            cls = char_classes.get(ch)
+            if cls is None:
+                cls = char_classes[ch] = (ch.isalpha(), ch.isupper())
+            if cls[0]:
+                letters += n
+                if cls[1]:
+                    caps += n
+        caps_ratio = caps / letters if letters else 0.0
+        return counts['?'], counts['!'], caps_ratio
+
+    def _scan_keyword_counts(self, text: str) -> Dict[str, int]:
+        """
+        Conta keywords distintas de todas as categorias em uma única passada
+        """
+        counts = {'technical': 0, 'business': 0, 'support': 0, 'social': 0,
+                  'urgency': 0, 'negative': 0, 'positive': 0}
+        seen = set()
+        if self._keyword_automaton is not None:
+            for _, (keyword, categories) in self._keyword_automaton.iter(text):
+                if keyword not in seen:
+                    seen.add(keyword)
+                    for category in categories:
+                        counts[category] += 1
+        else:
+            for match in self._keyword_scan_re.finditer(text):
+                keyword = match.group(0)
+                if keyword not in seen:
+                    seen.add(keyword)
+                    for category in self._keyword_categories[keyword]:
+                        counts[category] += 1
+        return counts
+
+    def extract_all_features(self, text: str, subject: str = None, metadata: Dict[str, Any] = None) -> Dict[str, Any]:
         """
         Extrai todas as features do texto
-        
+
+        Args:
+            text: Texto original
+            subject: Assunto do email
+            metadata: Metadados já extraídos pelo NLPPreprocessor (urls, emails,
+                      phones) — quando fornecidos, evita varrer o texto de novo
+
         Returns:
             Dict com features numéricas e categóricas
         """
         try:
             full_text = f"{subject or ''} {text}".lower()
-            
+            keyword_counts = self._scan_keyword_counts(full_text)
+            question_count, exclamation_count, caps_ratio = self._scan_chars(text)
+            metadata = metadata or {}
+
+            # Scores calculados uma única vez (a partir da varredura única de
+            # keywords) e compartilhados com a classificação e a confiança —
+            # antes cada uma refazia os 4 cálculos (normaliza 3 matches = 1.0)
+            technical = min(keyword_counts['technical'] / 3.0, 1.0)
+            business = min(keyword_counts['business'] / 3.0, 1.0)
+            support = min(keyword_counts['support'] / 3.0, 1.0)
+            social = min(keyword_counts['social'] / 3.0, 1.0)
+
             features = {
                 # Features estruturais
                 'text_length': len(text),
@@ -55,40 +218,40 @@ class TextFeatureExtractor:
                 'sentence_count': self._count_sentences(text),
                 'avg_word_length': self._avg_word_length(text),
                 
-                # Features de pontuação
-                'question_count': text.count('?'),
-                'exclamation_count': text.count('!'),
-                'has_multiple_questions': text.count('?') >= 2,
-                'has_excessive_exclamations': text.count('!') >= 3,
+                # Features de pontuação (reutilizam a passada única de chars)
+                'question_count': question_count,
+                'exclamation_count': exclamation_count,
+                'has_multiple_questions': question_count >= 2,
+                'has_excessive_exclamations': exclamation_count >= 3,
                 
-                # Features de formatação
-                'has_urls': bool(re.search(r'http[s]?://', text)),
-                'has_email_addresses': bool(re.search(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', text)),
-                'has_phone_numbers': bool(re.search(r'\(?\d{2}\)?[\s-]?\d{4,5}[\s-]?\d{4}', text)),
-                'caps_lock_ratio': self._calculate_caps_ratio(text),
+                # Features de formatação (reutiliza extrações do preprocessor quando disponíveis)
+                'has_urls': bool(metadata['urls']) if 'urls' in metadata else bool(self._re_url.search(text)),
+                'has_email_addresses': bool(metadata['emails']) if 'emails' in metadata else bool(self._re_email.search(text)),
+                'has_phone_numbers': bool(metadata['phones']) if 'phones' in metadata else bool(self._re_phone.search(text)),
+                'caps_lock_ratio': caps_ratio,
                 
                 # Features de conteúdo
-                'technical_score': self._calculate_keyword_score(full_text, self.technical_keywords),
-                'business_score': self._calculate_keyword_score(full_text, self.business_keywords),
-                'support_score': self._calculate_keyword_score(full_text, self.support_keywords),
-                'social_score': self._calculate_keyword_score(full_text, self.social_keywords),
+                'technical_score': technical,
+                'business_score': business,
+                'support_score': support,
+                'social_score': social,
                 
                 # Features de urgência
-                'urgency_score': self._calculate_urgency_score(full_text),
+                'urgency_score': self._calculate_urgency_score(full_text, keyword_counts['urgency']),
                 'has_deadline_mention': self._has_deadline_mention(full_text),
-                
-                # Features de sentimento (básico)
-                'negative_words_count': self._count_negative_words(full_text),
-                'positive_words_count': self._count_positive_words(full_text),
+
+                # Features de sentimento (básico) - saem da mesma varredura
+                'negative_words_count': keyword_counts['negative'],
+                'positive_words_count': keyword_counts['positive'],
                 
                 # Features de especificidade
-                'has_specific_numbers': bool(re.search(r'\b\d+\b', text)),
-                'has_specific_dates': bool(re.search(r'\d{1,2}[/-]\d{1,2}[/-]\d{2,4}', text)),
-                'has_bullet_points': bool(re.search(r'^\s*[-•*]\s', text, re.MULTILINE)),
+                'has_specific_numbers': bool(self._re_number.search(text)),
+                'has_specific_dates': bool(self._re_date.search(text)),
+                'has_bullet_points': bool(self._re_bullet.search(text)),
                 
                 # Classificação simplificada baseada em features
-                'feature_based_category': self._classify_by_features(full_text),
-                'confidence_score': self._calculate_confidence(full_text)
+                'feature_based_category': self._classify_by_features(technical, business, support, social),
+                'confidence_score': self._calculate_confidence(technical, business, support, social)
             }
             
             logger.info(f"[FEATURES] Extracted features: technical={features['technical_score']:.2f}, "
@@ -101,9 +264,22 @@ class TextFeatureExtractor:
             logger.error(f"[FEATURES] Error extracting features: {str(e)}")
             return {}
     
+    def extract_all_features_batch(self, texts: List[str], subjects: List[str] = None) -> List[Dict[str, Any]]:
+        """
+        Extrai features de vários emails de uma vez (pipelines de ingestão).
+        Cada email já custa uma única passada nos scanners em C, então o
+        batch serve para amortizar o overhead por chamada no chamador.
+        """
+        if subjects is None:
+            subjects = [None] * len(texts)
+        return [
+            self.extract_all_features(text, subject)
+            for text, subject in zip(texts, subjects)
+        ]
+
     def _count_sentences(self, text: str) -> int:
         """Conta aproximadamente o número de sentenças"""
-        sentences = re.split(r'[.!?]+', text)
+        sentences = self._re_sentence_split.split(text)
         return len([s for s in sentences if s.strip()])
     
     def _avg_word_length(self, text: str) -> float:
@@ -116,94 +292,28 @@ class TextFeatureExtractor:
     
     def _calculate_caps_ratio(self, text: str) -> float:
         """Calcula proporção de letras em CAPS LOCK"""
-        if not text:
-            return 0.0
-        letters = [c for c in text if c.isalpha()]
-        if not letters:
-            return 0.0
-        caps_count = sum(1 for c in letters if c.isupper())
-        return caps_count / len(letters)
+        return self._scan_chars(text)[2]
     
-    def _calculate_keyword_score(self, text: str, keywords: List[str]) -> float:
-        """
-        Calcula score baseado em presença de keywords (0.0 a 1.0)
-        """
-        if not keywords:
-            return 0.0
-        
-        matches = sum(1 for keyword in keywords if keyword in text)
-        return min(matches / 3.0, 1.0)  # Normaliza até 3 matches = score 1.0
-    
-    def _calculate_urgency_score(self, text: str) -> float:
+    def _calculate_urgency_score(self, text: str, urgency_matches: int) -> float:
         """Calcula score de urgência (0.0 a 1.0)"""
-        urgency_keywords = [
-            'urgente', 'imediato', 'asap', 'rápido', 'prazo',
-            'emergência', 'crítico', 'quanto antes'
-        ]
-        
-        score = 0.0
-        
-        # Palavras de urgência (+0.3 cada)
-        for keyword in urgency_keywords:
-            if keyword in text:
-                score += 0.3
-        
+        # Palavras de urgência (+0.3 cada), já contadas pela varredura única
+        score = urgency_matches * 0.3
+
         # Exclamações múltiplas (+0.2)
         if text.count('!') >= 2:
             score += 0.2
-        
-        # CAPS LOCK excessivo (+0.2)
-        caps_ratio = self._calculate_caps_ratio(text)
-        if caps_ratio > 0.5:
-            score += 0.2
-        
+
         return min(score, 1.0)
     
     def _has_deadline_mention(self, text: str) -> bool:
         """Detecta menção a prazos ou datas limites"""
-        deadline_patterns = [
-            r'prazo',
-            r'até (hoje|amanhã|segunda|terça|quarta|quinta|sexta)',
-            r'até (?:dia|o dia) \d{1,2}',
-            r'deadline',
-            r'data limite'
-        ]
-        
-        for pattern in deadline_patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                return True
-        
-        return False
-    
-    def _count_negative_words(self, text: str) -> int:
-        """Conta palavras negativas"""
-        negative_words = [
-            'não', 'nunca', 'nada', 'ninguém', 'problema', 'erro',
-            'falha', 'ruim', 'péssimo', 'horrível', 'insatisfeito',
-            'reclamação', 'decepcionado', 'frustrado'
-        ]
-        
-        return sum(1 for word in negative_words if word in text)
+        return bool(self._deadline_combined.search(text))
     
-    def _count_positive_words(self, text: str) -> int:
-        """Conta palavras positivas"""
-        positive_words = [
-            'obrigado', 'agradeço', 'excelente', 'ótimo', 'bom',
-            'parabéns', 'feliz', 'satisfeito', 'gostei', 'adorei'
-        ]
-        
-        return sum(1 for word in positive_words if word in text)
-    
-    def _classify_by_features(self, text: str) -> str:
+    def _classify_by_features(self, technical: float, business: float, support: float, social: float) -> str:
         """
         Classificação básica baseada apenas em features
         (usado como fallback adicional ou validação)
         """
-        technical = self._calculate_keyword_score(text, self.technical_keywords)
-        business = self._calculate_keyword_score(text, self.business_keywords)
-        support = self._calculate_keyword_score(text, self.support_keywords)
-        social = self._calculate_keyword_score(text, self.social_keywords)
-        
         # Se tem score alto em technical/business/support → productive
         if technical > 0.3 or business > 0.3 or support > 0.3:
             return 'productive'
@@ -215,15 +325,10 @@ class TextFeatureExtractor:
         # Default conservador
         return 'uncertain'
     
-    def _calculate_confidence(self, text: str) -> float:
+    def _calculate_confidence(self, technical: float, business: float, support: float, social: float) -> float:
         """
         Calcula confiança da classificação baseada em features (0.0 a 1.0)
         """
-        technical = self._calculate_keyword_score(text, self.technical_keywords)
-        business = self._calculate_keyword_score(text, self.business_keywords)
-        support = self._calculate_keyword_score(text, self.support_keywords)
-        social = self._calculate_keyword_score(text, self.social_keywords)
-        
         # Confiança alta quando há scores claros em uma categoria
         max_score = max(technical, business, support, social)
         